@@ -26,12 +26,15 @@
 
 import base64
 import copy
+import fnmatch
+import hashlib
+import math
 import sys
 import urllib.parse
 import urllib.request
 import os
-from pathlib import Path
 
+from concurrent.futures import Future, ProcessPoolExecutor
 from lxml import etree
 from builtins import str
 
@@ -42,9 +45,17 @@ sys.path.append('./ebooklib')
 
 import re
 import inkex
-import scour.scour
 import ebooklib
 import larscwallin_inx_ebooklib_epub as inx_epub
+import larscwallin_inx_pipeline as inx_pipeline
+import larscwallin_inx_cache as inx_cache
+import larscwallin_inx_defs as inx_defs
+import larscwallin_inx_analysis as inx_analysis
+import larscwallin_inx_resources as inx_resources
+import larscwallin_inx_report as inx_report
+import larscwallin_inx_fonts as inx_fonts
+import larscwallin_inx_images as inx_images
+import larscwallin_inx_optimize as inx_optimize
 
 
 class ExportToEpub(inkex.Effect):
@@ -72,7 +83,7 @@ class ExportToEpub(inkex.Effect):
     font_face_template = """
     @font-face {
       font-family: {{font.family}};
-      src: url("{{font.url}}");
+      src: url("{{font.url}}");{{font.descriptors}}
     }
     """
 
@@ -104,6 +115,128 @@ class ExportToEpub(inkex.Effect):
                                      type=inkex.Boolean, dest='wrap_svg_in_html', default=False,
                                      help='Save documents as HTML instead of SVG?')
 
+        self.arg_parser.add_argument('--jobs', action='store',
+                                     type=int, dest='jobs', default=0,
+                                     help='Number of worker processes used to render the layers. '
+                                          '0 uses all available CPUs, 1 renders the layers one at a time.')
+
+        self.arg_parser.add_argument('--optimizer', action='store',
+                                     type=str, dest='optimizer', default='tree',
+                                     help='"tree" optimizes each document as it is parsed, in a single pass. '
+                                          '"scour" runs each document through Scour, like earlier versions did.')
+
+        self.arg_parser.add_argument('--pretty_print', action='store',
+                                     type=inkex.Boolean, dest='pretty_print', default=False,
+                                     help='Indent the documents instead of writing them as compact as possible?')
+
+        self.arg_parser.add_argument('--strip_hidden', action='store',
+                                     type=inkex.Boolean, dest='strip_hidden', default=False,
+                                     help='Leave out hidden sublayers and other content that is not rendered? '
+                                          'Documents with style elements and pages with scripts are left as they '
+                                          'are, since style sheets and scripts can show hidden content.')
+
+        self.arg_parser.add_argument('--subset_fonts', action='store',
+                                     type=inkex.Boolean, dest='subset_fonts', default=False,
+                                     help='Only keep the glyphs of the characters used in the publication in the '
+                                          'fonts? Needs fontTools.')
+
+        self.arg_parser.add_argument('--woff2_fonts', action='store',
+                                     type=inkex.Boolean, dest='woff2_fonts', default=False,
+                                     help='Convert TTF and OTF fonts to WOFF2? Needs fontTools and brotli.')
+
+        self.arg_parser.add_argument('--referenced_resources_only', action='store',
+                                     type=inkex.Boolean, dest='referenced_resources_only', default=False,
+                                     help='Only add the resources that the pages reference, through images, fonts, '
+                                          'scripts and CSS url() values, to the EPUB? The other files are listed '
+                                          'instead.')
+
+        self.arg_parser.add_argument('--resource_allowlist', action='store',
+                                     type=str, dest='resource_allowlist', default='',
+                                     help='Comma separated file name patterns, relative to the resources folder, of '
+                                          'resources that are always added, like files that scripts load.')
+
+        self.arg_parser.add_argument('--deduplicate_resources', action='store',
+                                     type=inkex.Boolean, dest='deduplicate_resources', default=False,
+                                     help='Only add one copy of resources with the same content to the EPUB? '
+                                          'References to the other copies are pointed at that one.')
+
+        self.arg_parser.add_argument('--extract_embedded_images', action='store',
+                                     type=inkex.Boolean, dest='extract_embedded_images', default=True,
+                                     help='Save images embedded as data: URIs as files in the EPUB? Images that are '
+                                          'embedded more than once are only stored once.')
+
+        self.arg_parser.add_argument('--optimize_images', action='store',
+                                     type=inkex.Boolean, dest='optimize_images', default=False,
+                                     help='Scale images down to the size they are shown at and compress them? '
+                                          'Needs Pillow.')
+
+        self.arg_parser.add_argument('--image_dpr', action='store',
+                                     type=float, dest='image_dpr', default=2.0,
+                                     help='Device pixel ratio that images are scaled for. 2 keeps twice as many '
+                                          'pixels as the viewport has, for high resolution screens.')
+
+        self.arg_parser.add_argument('--image_format', action='store',
+                                     type=str, dest='image_format', default='auto',
+                                     help='"auto" keeps JPEG images JPEG and saves other images as PNG. "jpeg", '
+                                          '"png" and "webp" save all images in that format. Images with '
+                                          'transparency are never saved as JPEG.')
+
+        self.arg_parser.add_argument('--image_quality', action='store',
+                                     type=int, dest='image_quality', default=85,
+                                     help='JPEG and WebP quality of optimized images, 1-100.')
+
+        self.arg_parser.add_argument('--cache_folder', action='store',
+                                     type=str, dest='cache_folder', default='',
+                                     help='Optional folder where rendered layers are cached between exports. '
+                                          'Unchanged layers are then taken from the cache instead of being rendered again.')
+
+        self.arg_parser.add_argument('--cache_size', action='store',
+                                     type=int, dest='cache_size', default=512,
+                                     help='Maximum size of the layer cache in megabytes.')
+
+        self.arg_parser.add_argument('--incremental', action='store',
+                                     type=inkex.Boolean, dest='incremental', default=False,
+                                     help='Update an existing EPUB at the output path, only compressing the '
+                                          'files that have changed since it was written?')
+
+        self.arg_parser.add_argument('--streaming', action='store',
+                                     type=inkex.Boolean, dest='streaming', default=False,
+                                     help='Write each document to the EPUB as soon as it is done, instead of '
+                                          'keeping all of them in memory until the end?')
+
+        self.arg_parser.add_argument('--compress_level', action='store',
+                                     type=int, dest='compress_level', default=6,
+                                     help='Deflate level (1-9) for text formats. Formats that are already '
+                                          'compressed, like JPEG, PNG, WOFF and MP3, are stored as they are.')
+
+        self.arg_parser.add_argument('--sample_compression', action='store',
+                                     type=inkex.Boolean, dest='sample_compression', default=False,
+                                     help='Test compress a sample of files with unknown media types to decide '
+                                          'whether to store or deflate them?')
+
+        self.arg_parser.add_argument('--compress_jobs', action='store',
+                                     type=int, dest='compress_jobs', default=1,
+                                     help='Number of threads used to compress the files in the EPUB. '
+                                          '0 uses all available CPUs.')
+
+        self.arg_parser.add_argument('--compress_profile', action='store',
+                                     type=str, dest='compress_profile', default='default',
+                                     help='"default" or "max". "max" gives smaller files for release builds but '
+                                          'is much slower. It uses zopfli in worker processes if it is installed.')
+
+        self.arg_parser.add_argument('--compression_report', action='store',
+                                     type=inkex.Boolean, dest='compression_report', default=False,
+                                     help='Report the bytes and time saved by compression per media type?')
+
+        self.arg_parser.add_argument('--build_report', action='store',
+                                     type=inkex.Boolean, dest='build_report', default=False,
+                                     help='Write a JSON report with the time spent in each stage and on each layer '
+                                          'next to the EPUB?')
+
+        self.arg_parser.add_argument('--trace', action='store',
+                                     type=inkex.Boolean, dest='trace', default=False,
+                                     help='Also write the timings in the Chrome trace format, for chrome://tracing?')
+
     def effect(self):
         self.publication_title = "Publication Title"
         self.publication_desc = ""
@@ -116,8 +249,48 @@ class ExportToEpub(inkex.Effect):
         self.resources_folder = self.options.resources_folder
         self.filename = self.options.filename
         self.resource_items = []
+        # (xlink:href, sodipodi:absref) -> (mime type, relative resource path) for the images found so far
+        self.image_resources = {}
+        # sha256 of an image embedded as a data: URI -> file name of the image in the EPUB
+        self.embedded_images = {}
+        # font-family -> {(font weight, font style): (renamed font family, catalog font)}, see resolve_fonts()
+        self.font_faces = {}
+        # path of a font file -> list of the (font family, font weight, font style) that it is used for
+        self.font_files = {}
+        # path of a font file in the EPUB -> new path, for fonts that have been converted to another format
+        self.font_urls = {}
+        # (renamed font family, path of the font file) -> @font-face declaration
+        self.font_face_rules = {}
         self.bottom_layer_as_cover = self.options.bottom_layer_as_cover
         self.wrap_svg_in_html = self.options.wrap_svg_in_html
+        self.jobs = self.options.jobs
+        self.optimizer = self.options.optimizer
+        self.pretty_print = self.options.pretty_print
+        self.strip_hidden = self.options.strip_hidden
+        self.subset_fonts = self.options.subset_fonts
+        self.woff2_fonts = self.options.woff2_fonts
+        self.referenced_resources_only = self.options.referenced_resources_only
+        self.resource_allowlist = [pattern.strip() for pattern in self.options.resource_allowlist.split(',')
+                                   if pattern.strip()]
+        self.deduplicate_resources = self.options.deduplicate_resources
+        self.extract_embedded_images = self.options.extract_embedded_images
+        self.optimize_images = self.options.optimize_images
+        self.image_dpr = self.options.image_dpr
+        self.image_format = self.options.image_format
+        self.image_quality = self.options.image_quality
+        self.cache_folder = self.options.cache_folder
+        self.cache_size = self.options.cache_size
+        self.incremental = self.options.incremental
+        self.streaming = self.options.streaming
+        self.compress_level = self.options.compress_level
+        self.sample_compression = self.options.sample_compression
+        self.compression_report = self.options.compression_report
+        self.compress_jobs = self.options.compress_jobs
+        self.compress_profile = self.options.compress_profile
+        self.build_report = self.options.build_report
+        self.trace = self.options.trace
+        # Timers and counters of this export
+        self.report = inx_report.BuildReport()
         self.svg_doc = self.document.xpath('//svg:svg', namespaces=inkex.NSS)[0]
         self.svg_doc_width = float(self.svg.unittouu(self.svg_doc.get('width')))
         self.svg_doc_height = float(self.svg.unittouu(self.svg_doc.get('height')))
@@ -125,45 +298,61 @@ class ExportToEpub(inkex.Effect):
         self.svg_viewport_height = float(self.svg.unittouu(self.svg_doc.get('height')))
         self.svg_nav_doc = ebooklib.epub.EpubNav()
 
+        # Walk the document once to find the layers, defs, scripts, fonts, images and ids that the later
+        # stages need, instead of searching the document again for each of them.
+        with self.report.stage('analysis'):
+            self.document_index = inx_analysis.DocumentIndex(self.document.getroot())
+
+        # Hidden content is removed before the resources, fonts and images are collected, so that what only the
+        # hidden content uses is left out as well. The document is analysed again if anything was removed.
+        # Scripts, and CSS rules and animations, can show hidden content, so documents with root scripts or style
+        # elements and pages with scripts are left as they are.
+        if self.strip_hidden and len(self.document_index.scripts) == 0 and self.document_index.style_elements == 0:
+            with self.report.stage('hidden content'):
+                removed = self.remove_hidden_content()
+
+            if removed > 0:
+                self.report.count('hidden elements removed', removed)
+
+                with self.report.stage('analysis'):
+                    self.document_index = inx_analysis.DocumentIndex(self.document.getroot())
+
+        self.report.count('elements', self.document_index.element_count)
+
         # We only care about the "root layers" that are visible. Sub-layers will be included.
-        self.visible_layers = self.document.xpath('/svg:svg/svg:g[not(contains(@style,"display:none"))]',
-                                                  namespaces=inkex.NSS)
+        self.visible_layers = self.document_index.visible_layers
         # Create a new EPUB instance
-        self.book = ebooklib.epub.EpubBook()
+        self.book = inx_epub.InxEpubBook(deduplicate=self.deduplicate_resources)
 
         if self.visible_layers.__len__() > 0:
-            selected_layers = []
             content_documents = []
 
-            # Get all defs elements. These are "injected" in each of the documents
-            defs = self.document.xpath('//svg:svg/svg:defs', namespaces=inkex.NSS)
-            defs_string = ''
+            # Get all defs elements. The defs that a layer uses are "injected" in each of the documents
+            defs = self.document_index.defs
 
             # Get all script elements in the document root. These are "injected" in each of the documents.
             # Script elements that are children of layers are unique to each document.
-            scripts = self.document.xpath('//svg:svg/svg:script', namespaces=inkex.NSS)
+            scripts = self.document_index.scripts
             scripts_string = ''
 
-            # We get all text elements in order to later get all used font-families.
-            text_elements = self.document.xpath('//svg:text', namespaces=inkex.NSS)
-            font_families = {}
-            font_faces_string = ''
+            # The resources folder is walked once. Fonts, images and the resources added to the EPUB are all
+            # looked up in the index.
+            with self.report.stage('resource index'):
+                self.resource_index = inx_resources.ResourceIndex(self.root_folder, self.resources_folder)
 
-            resource_folder_path = os.path.join(self.root_folder, self.resources_folder)
-            # Call add_resources to recursively add resources to the EPUB instance.
-            self.add_resources(resource_folder_path)
+            self.report.count('resources ignored', self.resource_index.ignored)
 
-            # Now let's go through the text elements and see which font families that are used.
-            for text in text_elements:
-                style = inkex.Style(text.get('style'))
+            # Call add_resources to add all resources to the EPUB instance.
+            with self.report.stage('resources'):
+                self.add_resources()
 
-                if style['font-family']:
-                    font = style['font-family']
-                    if font not in font_families:
-                        font_families[font] = font
+                # Style sheets and HTML files that reference a copy that was left out are pointed at the one kept
+                if self.book.duplicates:
+                    self.rewrite_resource_urls(self.book.duplicates)
 
             # Time to loop through the script elements if there are any
             if len(scripts) > 0:
+                self.report.count('scripts', len(scripts))
 
                 for script in scripts:
                     xlink = script.get('xlink:href')
@@ -201,15 +390,13 @@ class ExportToEpub(inkex.Effect):
                 # No scripts so we just add a self closing element
                 scripts_string = '<script />'
 
-            # If we found defs we loop through them and add them to string which will be inserted in every document.
-            # Note that we use Scour later for each doc to remove unused defs.
-            if len(defs) > 0:
-                for element in defs:
-                    defs_string += str(etree.tostring(element, method='html', pretty_print=False), 'utf-8')
-            else:
-                defs_string = '<defs/>'
+            # Index the defs and the references between them once, so that each document only gets the defs
+            # that it actually uses instead of leaving it to Scour to remove the unused ones from every document.
+            with self.report.stage('defs index'):
+                defs_index = inx_defs.DefsIndex(self.document.getroot(), defs, self.document_index.elements,
+                                                self.document_index.order)
 
-            metadata = self.document.xpath('//svg:svg/svg:metadata/rdf:RDF/cc:Work', namespaces=inkex.NSS)
+            metadata = self.document_index.metadata
 
             metadata_items = {
                 'title': '',
@@ -222,8 +409,8 @@ class ExportToEpub(inkex.Effect):
                 'language': ''
             }
 
-            if len(metadata[0]) > 0:
-                for element in metadata[0]:
+            if metadata is not None and len(metadata) > 0:
+                for element in metadata:
                     # Copy the node to make sure that the input document is not mutated when we remove namespaces
                     element_copy = copy.deepcopy(element)
                     # Me being lazy. Flatten any metadata item to only include text
@@ -251,93 +438,135 @@ class ExportToEpub(inkex.Effect):
             self.book.add_metadata(None, 'meta', 'pre-paginated', {'property': 'rendition:layout'})
             self.book.add_metadata(None, 'meta', 'auto', {'property': 'rendition:orientation'})
 
-            # All visible layers will be saved as FXL docs in the EPUB. Let's loop through them!
-            for element in self.visible_layers:
-
-                # Save all images to the epub package
-                self.save_images_to_epub(element, self.book)
-
-                element_label = str(element.get(inkex.utils.addNS('label', 'inkscape'), ''))
-                element_id = element.get('id').replace(' ', '_')
-
-                if element_label != '':
-                    element.set('label', element_label)
-                    element.set('class', element_label)
+            # The @font-face declarations of the fonts are resolved once, before the layers are rendered. Each
+            # page only declares the fonts that it uses.
+            with self.report.stage('font resolution'):
+                self.resolve_fonts()
+
+            # Rendered layers and font subsets that have not changed since the last export are taken from the
+            # cache, if there is one
+            cache = None
+            if self.cache_folder != '':
+                cache = inx_cache.LayerCache(os.path.expanduser(self.cache_folder), self.cache_size * 1024 * 1024)
+
+            # Leave out the resources that no page uses before any of them are processed
+            if self.referenced_resources_only:
+                with self.report.stage('reachability'):
+                    self.remove_unreferenced_resources()
+
+            if self.subset_fonts:
+                if inx_fonts.font_subset is None:
+                    inkex.utils.debug('fontTools is not installed, fonts are not subset')
                 else:
-                    pass
-
-                element_source = etree.tostring(element, pretty_print=True)
+                    with self.report.stage('font subsetting'):
+                        self.subset_font_files(cache)
 
-                if element_source != '':
-                    # Wrap the node in an SVG doc
-                    tpl_result = str.replace(self.svg_src_template, '{{defs}}', defs_string)
-                    tpl_result = str.replace(tpl_result, '{{scripts}}', scripts_string)
-                    tpl_result = str.replace(tpl_result, '{{title}}', element_label)
-                    tpl_result = str.replace(tpl_result, '{{viewport.width}}', str(self.svg_viewport_width))
-                    tpl_result = str.replace(tpl_result, '{{viewport.height}}', str(self.svg_viewport_height))
-                    tpl_result = str.replace(tpl_result, '{{document.width}}', str(self.svg_doc_width))
-                    tpl_result = str.replace(tpl_result, '{{document.height}}', str(self.svg_doc_height))
-                    tpl_result = str.replace(tpl_result, '{{element.source}}', str(element_source, 'utf-8'))
-
-                    for font in font_families:
-                        font_family = str.replace(font, ' ', '+')
-                        font_family = str.replace(font_family, "'", '')
-
-                        tpl_result = str.replace(tpl_result, font, font_family)
-
-                        resource_path = os.path.join(self.root_folder, self.resources_folder)
-                        font_file_name = self.find_file_fuzzy(font_family, resource_path)
-
-                        if font_file_name is not None:
-                            font_path = self.get_relative_resource_path(font_file_name)
-                            font_tpl_result = str.replace(self.font_face_template, '{{font.family}}', font_family)
-                            font_tpl_result = str.replace(font_tpl_result, '{{font.url}}', font_path)
-
-                            font_faces_string = font_faces_string + font_tpl_result
-                        else:
-                            inkex.utils.debug('Could not find matching font file ' + font_family + ' in location ' + resource_path)
-
-                    tpl_result = str.replace(tpl_result, '{{font-faces}}', font_faces_string)
+            if self.woff2_fonts:
+                if not inx_fonts.can_convert_to_woff2():
+                    inkex.utils.debug('fontTools and brotli are needed to convert fonts to WOFF2, fonts are not converted')
+                else:
+                    with self.report.stage('woff2 conversion'):
+                        self.convert_fonts_to_woff2(cache)
+
+            # Embedded images are saved as files before the layers are serialized, so that their data is not
+            # carried through templating and optimization, and images used on many pages are stored once
+            if self.extract_embedded_images:
+                with self.report.stage('embedded images'):
+                    self.save_embedded_images()
+
+            if self.optimize_images:
+                if inx_images.Image is None:
+                    inkex.utils.debug('Pillow is not installed, images are not optimized')
+                else:
+                    with self.report.stage('image optimization'):
+                        self.optimize_image_files(cache)
+
+            # The image hrefs are made relative to the EPUB once, before any page is serialized. Pages also copy
+            # images from defs and from other layers, and those copies must point at the files in the EPUB too.
+            with self.report.stage('images'):
+                images = [image for layer_info in self.visible_layers for image in layer_info.images]
+                images.extend(self.document_index.shared_images)
+                self.save_images_to_epub(self.svg_doc, self.book, images)
+
+            context = {
+                'template': self.svg_src_template,
+                'scripts': scripts_string,
+                'viewport': (self.svg_viewport_width, self.svg_viewport_height),
+                'document': (self.svg_doc_width, self.svg_doc_height),
+                'optimizer': self.optimizer,
+                'pretty_print': self.pretty_print
+            }
 
-                    font_faces_string = ''
+            # The template and the values shared by all layers are put together once, so that each page is
+            # assembled with a single join
+            context['page'] = inx_pipeline.compile_page_template(context)
+
+            # Wrap each layer in an SVG doc and optimize it. Layers are independent of each other so this
+            # is done in a pool of worker processes, the documents are returned in spine order.
+            # Layers that have not changed since the last export are taken from the cache, if there is one.
+            epub_path = self.destination_path + '/' + self.filename
+            epub_options = {
+                'incremental': self.incremental,
+                'compress_level': self.compress_level,
+                'sample_compression': self.sample_compression,
+                'compress_jobs': self.compress_jobs,
+                'compress_profile': self.compress_profile
+            }
 
-                    tpl_result = self.scour_doc(tpl_result)
+            if self.compress_profile == 'max' and inx_epub.zopfli is None:
+                inkex.utils.debug('zopfli is not installed, using zlib level 9 for the "max" compression profile')
 
-                    # TODO: Add processing instsruction to head of file
-                    content_doc = etree.fromstring(tpl_result)
-                    content_doc = etree.ElementTree(content_doc)
+            # In streaming mode each document is written to the EPUB as soon as it is done, and then released.
+            # Otherwise the documents are collected and the whole book is written at the end.
+            writer = None
+            if self.streaming:
+                writer = inx_epub.InxEpubStreamWriter(epub_path, self.book, epub_options)
+                writer.open()
 
-                    # If the result of the operation is valid, add the SVG source to the selected array
-                    if tpl_result:
-                        selected_layers.append({
-                            'id': element_id,
-                            'label': element_label,
-                            'source': etree.tostring(content_doc, pretty_print=True),
-                            'element': element
-                        })
+            # The font and image stages use the same cache, only the lookups made while rendering are counted
+            # as layer cache hits and misses
+            if cache is not None:
+                cache_hits = cache.hits
+                cache_misses = cache.misses
 
-            for layer in selected_layers:
-                # Cache these in local vars
-                content = layer['source']
-                label = layer['label'] or layer['id']
-                label = label.replace(' ', '_')
+            try:
+                for layer, content in inx_pipeline.iter_render_layers(self.get_layers(defs_index), context,
+                                                                      self.jobs, cache, self.report):
+                    # If the result of the operation is not valid, skip the layer
+                    if not content:
+                        continue
 
-                if content != '':
+                    label = layer['label'] or layer['id']
+                    label = label.replace(' ', '_')
 
                     if self.wrap_svg_in_html:
                         doc = inx_epub.InxEpubHtml(uid=label, file_name=label + '.html', media_type='text/html',
                                             content=content, width=self.svg_viewport_width, height=self.svg_viewport_height)
 
-                        content_documents.append(doc)
-
                         self.book.toc.append(ebooklib.epub.Link(label + '.html', label, layer['id']))
 
                     else:
-                        content_documents.append(
-                            inx_epub.InxEpubSvg(uid=label, file_name=label + '.svg', media_type="image/svg+xml",
-                                         content=content))
-                else:
-                    pass
+                        doc = inx_epub.InxEpubSvg(uid=label, file_name=label + '.svg', media_type="image/svg+xml",
+                                                  content=content)
+
+                    if (len(scripts) > 0 or layer['scripted']) and 'cover-image' not in doc.properties:
+                        doc.properties.append('scripted')
+
+                    if writer is not None:
+                        writer.add_document(doc)
+                    else:
+                        content_documents.append(doc)
+            except:
+                if writer is not None:
+                    writer.discard()
+                raise
+
+            if cache is not None:
+                cache_hits = cache.hits - cache_hits
+                cache_misses = cache.misses - cache_misses
+                self.report.count('cache hits', cache_hits)
+                self.report.count('cache misses', cache_misses)
+                inkex.utils.debug('Layer cache: %d hits, %d misses' % (cache_hits, cache_misses))
 
             # Skip cover image for now. To be implemented later.
             """
@@ -358,50 +587,440 @@ class ExportToEpub(inkex.Effect):
                 self.book.set_cover('cover.xhtml', cover_content, create_page=False)
             """
 
-            for doc in content_documents:
+            with self.report.stage('epub write'):
+                if writer is not None:
+                    self.book.add_item(self.svg_nav_doc)
+                    writer.close()
+                else:
+                    for doc in content_documents:
+                        # add manifest item
+                        self.book.add_item(doc)
+
+                        # add spine item
+                        self.book.spine.append(doc)
 
-                if len(scripts) > 0 and 'cover-image' not in doc.properties:
-                    doc.properties.append('scripted')
+                    self.book.add_item(self.svg_nav_doc)
 
-                # add manifest item
-                self.book.add_item(doc)
+                    writer = inx_epub.write_epub(epub_path, self.book, epub_options)
 
-                # add spine item
-                self.book.spine.append(doc)
+            self.report.count('entries copied', writer.copied_entries)
+            self.report.count('entries written', writer.written_entries)
+            self.report.set('compression', writer.compression_stats)
 
-            self.svg_nav_doc
-            self.book.add_item(self.svg_nav_doc)
+            if self.incremental:
+                inkex.utils.debug('Reused %d unchanged files, wrote %d new or changed files'
+                                  % (writer.copied_entries, writer.written_entries))
 
-            inx_epub.write_epub((self.destination_path + '/' + self.filename), self.book, {})
+            if self.compression_report:
+                for line in writer.get_compression_report():
+                    inkex.utils.debug(line)
 
-            inkex.utils.debug('Saved EPUB file to ' + (self.destination_path + '/' + self.filename))
+            inkex.utils.debug('Saved EPUB file to ' + epub_path)
+
+            report_path = os.path.splitext(epub_path)[0]
+
+            if self.build_report:
+                self.report.write(report_path + '.build.json')
+
+            if self.trace:
+                self.report.write_trace(report_path + '.trace.json')
 
         else:
             inkex.utils.debug('No SVG elements or layers to export')
 
         # End of effect() method
 
-    def add_resources(self, folder=None):
-        if folder is None:
-            folder = self.resources_folder
+    def get_layers(self, defs_index):
+        """
+        Prepares the visible layers for rendering, one at a time.
+
+        :Returns:
+          Generator of (layer, job) tuples. The layer dict holds the 'id', 'label', number of 'elements' and
+          whether the layer is 'scripted'. The job dict is what the layer pipeline needs to render it.
+        """
+        # All visible layers will be saved as FXL docs in the EPUB. Let's loop through them!
+        for layer_info in self.visible_layers:
+            element = layer_info.element
+            references = (layer_info.references, layer_info.ids)
+            element_count = layer_info.element_count
+
+            element_label = str(element.get(inkex.utils.addNS('label', 'inkscape'), ''))
+            element_id = element.get('id').replace(' ', '_')
+
+            if element_label != '':
+                element.set('label', element_label)
+                element.set('class', element_label)
+            else:
+                pass
 
-        if os.path.isdir(folder):
-            for resource in os.listdir(folder):
-                resource_path = os.path.join(folder, resource)
-                if os.path.isdir(resource_path):
-                    self.add_resources(resource_path)
-                else:
-                    resource_content = self.read_file(resource_path, True)
-                    if resource_content is not None:
-                        rel_path = self.get_relative_resource_path(resource_path)
+            with self.report.stage('layer source'):
+                element_source = etree.tostring(element, pretty_print=True)
+
+            if element_source != '':
+                with self.report.stage('defs'):
+                    defs_string = defs_index.get_defs_string(element, references)
+
+                yield {'id': element_id, 'label': element_label, 'elements': element_count,
+                       'scripted': layer_info.scripted}, {
+                    'label': element_label,
+                    'source': str(element_source, 'utf-8'),
+                    'defs': defs_string,
+                    'font_faces': self.get_font_faces(layer_info)
+                }
+
+    def remove_hidden_content(self):
+        """
+        Removes the hidden content from the visible layers without scripts.
+
+        :Returns:
+          The number of elements removed
+        """
+        # Content that is referenced by id, like clip paths and the targets of use elements, is never stripped
+        referenced_ids = self.document_index.get_referenced_ids()
+        removed = 0
+
+        for layer_info in self.document_index.visible_layers:
+            if not layer_info.scripted:
+                removed += inx_optimize.remove_hidden_elements(layer_info.element, referenced_ids)
+
+        return removed
+
+    def resolve_fonts(self):
+        """
+        Finds the font files of the font families used in the document and prepares their @font-face declarations.
+        The font families in the document are renamed to the names used in the declarations.
+        """
+        resource_path = os.path.join(self.root_folder, self.resources_folder)
+        names = {}
+
+        # The family, weight and style of the fonts in the resources folder are read from the fonts themselves,
+        # and stored in the catalog so that only new and changed fonts are read next time
+        font_catalog = inx_fonts.FontCatalog(inx_fonts.get_catalog_path(self.cache_folder))
+        font_catalog.update((entry.path, entry.size, entry.mtime)
+                            for extension in inx_resources.FONT_EXTENSIONS
+                            for entry in self.resource_index.extensions.get(extension, []))
+        font_catalog.save()
+
+        self.report.count('fonts parsed', font_catalog.parsed)
+
+        for font, font_styles in self.document_index.font_styles.items():
+            font_family = str.replace(font, ' ', '+')
+            font_family = str.replace(font_family, "'", '')
+
+            names[font] = font_family
+            self.font_faces[font] = {}
+            fuzzy_font_face = None
+
+            for weight, style in font_styles:
+                catalog_font = font_catalog.find(font, weight, style)
+
+                # Fonts that can not be read are looked up by file name
+                if catalog_font is None:
+                    if fuzzy_font_face is None:
+                        font_file_name = self.find_file_fuzzy(font_family, inx_resources.FONT_EXTENSIONS)
+                        fuzzy_font_face = {'path': font_file_name} if font_file_name is not None else {}
+                    catalog_font = fuzzy_font_face
+
+                if catalog_font:
+                    self.font_files.setdefault(catalog_font['path'], []).append((font, weight, style))
+                    self.font_faces[font][(weight, style)] = (font_family, catalog_font)
+
+            if self.font_faces[font]:
+                self.report.count('fonts found')
+            else:
+                self.report.count('fonts missing')
+                inkex.utils.debug('Could not find matching font file ' + font_family + ' in location ' + resource_path)
+
+        # Rename the font families once, in the style attributes of the text and in style sheets, instead of in
+        # every page
+        inx_fonts.rename_font_families(self.document_index.font_elements, names, self.document_index.styles)
+
+    def subset_font_files(self, cache=None):
+        """
+        Replaces the fonts in the EPUB with subsets that only have the glyphs of the characters that they are used
+        for. Subsets are cached by the hash of the font and of the characters.
+        """
+        # Font files with the same content are one file in the EPUB, so the characters of both are kept
+        file_names = {}
+        for path, font_keys in self.font_files.items():
+            file_name = self.book.get_href(self.get_relative_resource_path(path))
+            file_names.setdefault(file_name, []).extend(font_keys)
+
+        for file_name, font_keys in file_names.items():
+            item = self.book.get_item_with_href(file_name)
+            if item is None:
+                continue
+
+            characters = set()
+            for font_key in font_keys:
+                characters.update(self.document_index.font_text.get(font_key, ()))
+
+            text = ''.join(sorted(characters))
+            content = item.get_content()
+            key = None
+            subset = None
+
+            if cache is not None:
+                key = cache.make_key('font subset', inx_fonts.fontTools.version, hashlib.sha256(content).hexdigest(),
+                                     hashlib.sha256(text.encode('utf-8')).hexdigest())
+                subset = cache.get(key)
+
+            if subset is None:
+                try:
+                    subset = inx_fonts.subset_font(content, text)
+                except Exception as err:
+                    inkex.utils.debug('Could not subset font ' + file_name + ': ' + str(err))
+                    continue
 
-                        item = inx_epub.InxEpubItem(file_name=rel_path, content=resource_content)
-                        self.book.add_item(item)
+                if cache is not None:
+                    cache.put(key, subset)
+            else:
+                self.report.count('font subset cache hits')
 
-                    else:
-                        inkex.utils.debug('"' + resource + '" is empty')
+            self.book.items[self.book.items.index(item)] = inx_epub.InxEpubItem(
+                uid=item.id, file_name=item.file_name, media_type=item.media_type, content=subset)
+
+            self.report.count('fonts subset')
+            self.report.count('font subset bytes saved', len(content) - len(subset))
+
+    def convert_fonts_to_woff2(self, cache=None):
+        """
+        Replaces the TTF and OTF fonts in the EPUB with WOFF2 versions of them. Converted fonts are cached by the
+        hash of the font. Style sheets in the resources that use the fonts are pointed at the WOFF2 versions.
+        """
+        # old file name -> WOFF2 file name
+        renamed = {}
+
+        for item in list(self.book.get_items()):
+            base, extension = os.path.splitext(item.file_name)
+            if extension.lower() not in inx_fonts.WOFF2_SOURCE_EXTENSIONS:
+                continue
+
+            # Leave the font alone if there already is a WOFF2 version of it
+            file_name = base + '.woff2'
+            if self.book.get_item_with_href(file_name) is not None:
+                continue
+
+            content = item.get_content()
+            key = None
+            woff2 = None
+
+            if cache is not None:
+                key = cache.make_key('woff2', inx_fonts.fontTools.version, hashlib.sha256(content).hexdigest())
+                woff2 = cache.get(key)
+
+            if woff2 is None:
+                try:
+                    woff2 = inx_fonts.convert_to_woff2(content)
+                except Exception as err:
+                    inkex.utils.debug('Could not convert font ' + item.file_name + ' to WOFF2: ' + str(err))
+                    continue
+
+                if cache is not None:
+                    cache.put(key, woff2)
+            else:
+                self.report.count('woff2 cache hits')
+
+            self.book.items[self.book.items.index(item)] = inx_epub.InxEpubItem(
+                uid=item.id, file_name=file_name, media_type='font/woff2', content=woff2)
+            self.font_urls[item.file_name] = file_name
+            renamed[item.file_name] = file_name
+
+            self.report.count('fonts converted to woff2')
+            self.report.count('woff2 bytes saved', len(content) - len(woff2))
+
+        if renamed:
+            self.rewrite_resource_urls(renamed)
+
+    def rewrite_resource_urls(self, renamed):
+        """
+        Points the style sheets and HTML files in the resources at the new names of renamed resources.
+
+        :Args:
+          - renamed: dict of old file name -> new file name in the EPUB
+        """
+        for index, item in enumerate(self.resource_items):
+            if os.path.splitext(item.file_name)[1].lower() not in inx_resources.TEXT_EXTENSIONS:
+                continue
+
+            text = item.get_content().decode('utf-8', errors='surrogateescape')
+            rewritten = inx_resources.rewrite_urls(text, item.file_name, renamed)
+
+            if rewritten == text:
+                continue
+
+            rewritten_item = inx_epub.InxEpubItem(uid=item.id, file_name=item.file_name, media_type=item.media_type,
+                                                  content=rewritten.encode('utf-8', errors='surrogateescape'))
+            self.book.items[self.book.items.index(item)] = rewritten_item
+            self.resource_items[index] = rewritten_item
+
+            self.report.count('resources rewritten')
+
+    def get_font_faces(self, layer_info):
+        """
+        Returns the @font-face declarations of the fonts used by a layer, and of the fonts used outside of the
+        layers, like in defs, as a str.
+        """
+        font_faces = []
+
+        for font_styles in (layer_info.font_styles, self.document_index.shared_font_styles):
+            for font, styles in font_styles.items():
+                for weight_style in styles:
+                    font_face = self.font_faces.get(font, {}).get(weight_style)
+                    if font_face is not None:
+                        font_face = self.get_font_face_rule(*font_face)
+                        if font_face not in font_faces:
+                            font_faces.append(font_face)
+
+        return ''.join(font_faces)
+
+    def get_font_face_rule(self, font_family, font):
+        """
+        Returns the @font-face declaration of a font file found by resolve_fonts().
+        """
+        key = (font_family, font['path'])
+
+        if key not in self.font_face_rules:
+            font_path = self.book.get_href(self.get_relative_resource_path(font['path']))
+            font_path = self.font_urls.get(font_path, font_path)
+            font_tpl_result = str.replace(self.font_face_template, '{{font.family}}', font_family)
+            font_tpl_result = str.replace(font_tpl_result, '{{font.url}}', font_path)
+            font_tpl_result = str.replace(font_tpl_result, '{{font.descriptors}}',
+                                          inx_fonts.get_font_face_descriptors(font) if 'weight' in font else '')
+
+            self.font_face_rules[key] = font_tpl_result
+
+        return self.font_face_rules[key]
+
+    def add_resources(self):
+        if os.path.isdir(self.resource_index.folder):
+            for entry in self.resource_index.entries:
+                # Resources can be large, so they are not read until the EPUB is written
+                item = inx_epub.InxEpubFileItem(file_name=entry.relative_path, path=entry.path, size=entry.size,
+                                                mtime=entry.mtime)
+                # Copies of a file that is already in the book are left out when deduplicating
+                if self.book.add_item(item) is not item:
+                    self.report.count('duplicate resources')
+                    self.report.count('duplicate bytes saved', item.size)
+                    continue
+
+                self.resource_items.append(item)
+
+                self.report.count('resources')
+                self.report.count('resource bytes', item.size)
         else:
-            inkex.utils.debug('"' + folder + '" is not a folder')
+            inkex.utils.debug('"' + self.resource_index.folder + '" is not a folder')
+
+    def get_resource_href(self, url, folder=None):
+        """
+        Returns the file name in the EPUB of the resource that a URL points to, or None if it does not point to a
+        file in the resources folder.
+
+        :Args:
+          - url: href or CSS url() value
+          - folder: folder that relative URLs are relative to. Default is the folder of the document.
+        """
+        url = urllib.parse.urlparse(url.strip())
+        if url.scheme not in ('', 'file'):
+            return None
+
+        href = urllib.request.url2pathname(url.path)
+        if href == '':
+            return None
+
+        if folder is not None and not os.path.isabs(href):
+            entry = self.resource_index.get(os.path.join(folder, href))
+        else:
+            # Relative to the document, or else to the project root folder
+            entry = self.resource_index.get(self.absolute_href(href)) or \
+                self.resource_index.get(os.path.join(self.resource_index.root_folder, href))
+
+        if entry is None:
+            return None
+
+        return self.book.get_href(entry.relative_path)
+
+    def get_referenced_resources(self):
+        """
+        Returns the set of the file names in the EPUB of the resources used by the visible layers: images, fonts,
+        scripts, files referenced by CSS url() values, also from referenced CSS files, and the allowlisted files.
+        """
+        referenced = set()
+        urls = set(self.document_index.shared_external_references)
+        font_styles = [self.document_index.shared_font_styles]
+        images = list(self.document_index.shared_images)
+
+        for layer_info in self.visible_layers:
+            urls.update(layer_info.external_references)
+            font_styles.append(layer_info.font_styles)
+            images.extend(layer_info.images)
+
+        for image in images:
+            xlink = image.get('xlink:href') or ''
+            if xlink != '' and xlink[:5] != 'data:':
+                resource = self.find_image_resource(image)
+                if resource is not None:
+                    referenced.add(resource[1])
+
+        for styles in font_styles:
+            for font, weight_styles in styles.items():
+                for weight_style in weight_styles:
+                    font_face = self.font_faces.get(font, {}).get(weight_style)
+                    if font_face is not None:
+                        referenced.add(self.book.get_href(self.get_relative_resource_path(font_face[1]['path'])))
+
+        for script in self.document_index.scripts:
+            if script.get('xlink:href'):
+                urls.add(script.get('xlink:href'))
+
+        for url in urls:
+            referenced.add(self.get_resource_href(url))
+
+        for entry in self.resource_index.entries:
+            name = os.path.relpath(entry.path, self.resource_index.folder).replace(os.sep, '/')
+            if any(fnmatch.fnmatch(name, pattern) for pattern in self.resource_allowlist):
+                referenced.add(self.book.get_href(entry.relative_path))
+
+        # Style sheets reference images and fonts of their own, relative to the style sheet
+        style_sheets = [file_name for file_name in referenced if file_name and file_name.lower().endswith('.css')]
+
+        while style_sheets:
+            entry = self.resource_index.relative_paths.get(style_sheets.pop())
+            if entry is None:
+                continue
+
+            with open(entry.path, 'r', encoding='utf-8', errors='replace') as handle:
+                css = handle.read()
+
+            for url in inx_analysis.URL_EXTERNAL.findall(css):
+                file_name = self.get_resource_href(url, os.path.dirname(entry.path))
+                if file_name is not None and file_name not in referenced:
+                    referenced.add(file_name)
+                    if file_name.lower().endswith('.css'):
+                        style_sheets.append(file_name)
+
+        referenced.discard(None)
+
+        return referenced
+
+    def remove_unreferenced_resources(self):
+        """
+        Removes the resources that the visible layers do not use from the EPUB, and lists them.
+        """
+        referenced = self.get_referenced_resources()
+        unreferenced = [item for item in self.resource_items if item.file_name not in referenced]
+
+        for item in unreferenced:
+            self.book.items.remove(item)
+            self.resource_items.remove(item)
+
+            self.report.count('unreferenced resources')
+            self.report.count('unreferenced bytes', item.size)
+
+        if unreferenced:
+            file_names = [item.file_name for item in unreferenced]
+            self.report.set('unreferenced files', file_names)
+            inkex.utils.debug('Left out %d resources that no page uses: %s' % (len(file_names), ', '.join(file_names)))
 
     def get_tag_name(self, node, ns='sodipodi'):
         type = node.get(inkex.utils.addNS('type', ns))
@@ -416,19 +1035,13 @@ class ExportToEpub(inkex.Effect):
         return tag_name
 
     def scour_doc(self, str):
-        return scour.scour.scourString(str).encode("UTF-8")
+        return inx_pipeline.scour_doc(str)
 
-    def find_file_fuzzy(self, name, folder):
-        folder = Path(folder)
-        files = folder.rglob('*' + name + '*.*')
-        for file in files:
-            return str(file)
-
-        return None
+    def find_file_fuzzy(self, name, extensions=None):
+        return self.resource_index.find_fuzzy(name, extensions)
 
     def get_relative_resource_path(self, resource_path):
-        rel_path = str.split(resource_path, self.root_folder)[1]
-        return str.replace(rel_path.lstrip('/\\'), '\\', '/')
+        return self.resource_index.get_relative_path(resource_path)
 
     def read_file(self, filename, binary=False):
 
@@ -520,8 +1133,6 @@ class ExportToEpub(inkex.Effect):
     # This will probably be changed back to its original purpose when I have time to refactor
     # the code a bit.
     def save_image_to_epub(self, image, book):
-        resource_folder_path = os.path.join(self.root_folder, self.resources_folder)
-
         xlink = image.get('xlink:href')
 
         if xlink is None or xlink == '':
@@ -534,47 +1145,286 @@ class ExportToEpub(inkex.Effect):
             # No need, data already embedded
             return
 
+        resource = self.find_image_resource(image)
+
+        if resource is not None:
+            file_type, file_name = resource
+
+            # We do not need to do this anymore since I have decided that all resources, including images
+            # must be put in the resources folder and all those have already been added to the EPUB package.
+            # item = inx_epub.InxEpubItem(uid=image.get('id'), file_name=file_name, media_type=file_type, content=handle.read(), create=False)
+            # self.book.add_item(item)
+
+            # Rewrite the urls
+            image.set('sodipodi:absref', file_name)
+            image.set('xlink:href', file_name)
+
+    def save_embedded_images(self):
+        """
+        Saves the images embedded as data: URIs in the visible layers and in defs as files in the EPUB, named by
+        the hash of their content, and points the image elements at the files.
+        """
+        images = [image for layer_info in self.visible_layers for image in layer_info.images]
+        images.extend(self.document_index.shared_images)
+
+        for image in images:
+            xlink = image.get('xlink:href') or ''
+            if xlink[:5] != 'data:':
+                continue
+
+            data = inx_images.decode_data_uri(xlink)
+            if data is None:
+                inkex.utils.debug('Could not decode the data: URI of image ' + str(image.get('id')))
+                continue
+
+            mime_type, content = data
+            digest = hashlib.sha256(content).hexdigest()
+
+            self.report.count('embedded images')
+            self.report.count('embedded image bytes', len(xlink))
+
+            if digest not in self.embedded_images:
+                file_name = 'images/' + digest[:32] + inx_images.get_extension(mime_type)
+                self.book.add_item(inx_epub.InxEpubItem(file_name=file_name, media_type=mime_type, content=content))
+                self.embedded_images[digest] = file_name
+
+                self.report.count('embedded images saved')
+
+            file_name = self.embedded_images[digest]
+            image.set('xlink:href', file_name)
+            self.image_resources[(file_name, image.get('sodipodi:absref'))] = (mime_type, file_name)
+
+    def find_image_resource(self, image):
+        """Returns a (mime type, relative resource path) tuple for an image element, or None"""
+        xlink = image.get('xlink:href')
+
+        # Images are often used on many pages so each file is only located and checked once per export
+        key = (xlink, image.get('sodipodi:absref'))
+
+        if key not in self.image_resources:
+            self.image_resources[key] = self.get_image_resource(image, xlink)
+
+        return self.image_resources[key]
+
+    def get_user_units(self, value):
+        """Returns a length in user units. Lengths without a unit already are in user units."""
+        try:
+            return float(value)
+        except ValueError:
+            return self.svg.unittouu(value)
+
+    def get_image_display_size(self, image, transform=None):
+        """
+        Returns the (width, height) in pixels that an image element is shown at, on a screen with the device pixel
+        ratio given by the image_dpr option, or None if the size can not be worked out.
+
+        :Args:
+          - image: the image element
+          - transform: transform from the image to the document, if it is not the one of the image where it is
+            defined, like for an image shown by a use element
+        """
+        try:
+            width = self.get_user_units(image.get('width'))
+            height = self.get_user_units(image.get('height'))
+            matrix = (transform if transform is not None else image.composed_transform()).matrix
+        except (TypeError, ValueError, AttributeError):
+            return None
+
+        # Pages show the document in a viewport of svg_viewport_width x svg_viewport_height pixels
+        scale_x = math.hypot(matrix[0][0], matrix[1][0]) * self.svg_viewport_width / self.svg_doc_width
+        scale_y = math.hypot(matrix[0][1], matrix[1][1]) * self.svg_viewport_height / self.svg_doc_height
+
+        return (int(math.ceil(width * scale_x * self.image_dpr)),
+                int(math.ceil(height * scale_y * self.image_dpr)))
+
+    def get_used_images(self, layer_info):
+        """
+        Returns a list of (image, transform) tuples for the images that use elements in a layer show, where
+        transform is the transform from the image to the document as it is shown by the use element.
+        """
+        used_images = []
+
+        for use in layer_info.element.iter(inkex.addNS('use', 'svg')):
+            href = use.get('xlink:href') or ''
+            target = self.document_index.elements.get(href[1:]) if href[:1] == '#' else None
+            if target is None:
+                continue
+
+            try:
+                transform = use.composed_transform() * inkex.Transform(
+                    translate=(self.get_user_units(use.get('x') or '0'), self.get_user_units(use.get('y') or '0')))
+            except (TypeError, ValueError, AttributeError):
+                continue
+
+            for image in target.iter(inx_analysis.IMAGE_TAG):
+                # The transforms from the used element down to the image
+                relative = inkex.Transform()
+                node = image
+                while node is not None:
+                    relative = inkex.Transform(node.get('transform')) * relative
+                    if node is target:
+                        break
+                    node = node.getparent()
+
+                used_images.append((image, transform * relative))
+
+        return used_images
+
+    def optimize_image_files(self, cache=None):
+        """
+        Scales the images in the resources folder and the images extracted from data: URIs down to the largest
+        size that they are shown at in the visible layers, and compresses them. Images are optimized in a pool of
+        worker processes, and cached by the hash of the image, the size and the settings.
+        """
+        settings = inx_images.get_image_settings(self.image_format, self.image_quality)
+        # relative resource path -> (width, height) in pixels
+        sizes = {}
+
+        for layer_info in self.visible_layers:
+            # Images reused by use elements, from defs or another layer, may be shown larger than where they are
+            for image, transform in [(image, None) for image in layer_info.images] + self.get_used_images(layer_info):
+                xlink = image.get('xlink:href') or ''
+                if xlink == '' or xlink[:5] == 'data:':
+                    continue
+
+                resource = self.find_image_resource(image)
+                size = self.get_image_display_size(image, transform)
+
+                if resource is None or size is None:
+                    continue
+
+                if resource[1] in sizes:
+                    size = (max(size[0], sizes[resource[1]][0]), max(size[1], sizes[resource[1]][1]))
+
+                sizes[resource[1]] = size
+
+        # [item, content, cache key, optimized image or Future]
+        images = []
+        # old file name -> new file name, of the images saved in another format
+        renamed = {}
+        pool = None
+        jobs = self.jobs if self.jobs > 0 else inx_pipeline.available_cpus()
+
+        try:
+            for file_name, size in sizes.items():
+                # Vector images are shown sharp at any size
+                item = self.book.get_item_with_href(file_name)
+                if item is None or item.media_type == 'image/svg+xml':
+                    continue
+
+                content = item.get_content()
+
+                key = None
+                optimized = None
+
+                if cache is not None:
+                    key = cache.make_key('image', inx_images.PIL.__version__, hashlib.sha256(content).hexdigest(),
+                                         size, sorted(settings.items()))
+                    optimized = cache.get(key)
+
+                if optimized is not None:
+                    self.report.count('image cache hits')
+                elif jobs > 1 and len(sizes) > 1:
+                    if pool is None:
+                        pool = ProcessPoolExecutor(max_workers=min(jobs, len(sizes)))
+                    optimized = pool.submit(inx_images.optimize_image, content, size, settings)
+                else:
+                    optimized = Future()
+                    try:
+                        optimized.set_result(inx_images.optimize_image(content, size, settings))
+                    except Exception as err:
+                        optimized.set_exception(err)
+
+                images.append([item, content, key, optimized])
+
+            for item, content, key, optimized in images:
+                if not isinstance(optimized, bytes):
+                    try:
+                        optimized = optimized.result() or b''
+                    except Exception as err:
+                        inkex.utils.debug('Could not optimize image ' + item.file_name + ': ' + str(err))
+                        continue
+
+                    # Images that can not be made smaller are cached as empty, so they are not tried again
+                    if cache is not None:
+                        cache.put(key, optimized)
+
+                file_name = self.replace_image(item, content, optimized)
+                if file_name is not None and file_name != item.file_name:
+                    renamed[item.file_name] = file_name
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True)
+
+        if renamed:
+            self.rewrite_resource_urls(renamed)
+
+    def replace_image(self, item, content, optimized):
+        """
+        Replaces an image in the EPUB with its optimized version, if that is smaller. The image elements that
+        show the image are pointed at the new file when the optimized image has another format.
+
+        :Returns:
+          The file name of the optimized image, or None if the image was not replaced
+        """
+        image_format = inx_images.get_image_format(optimized)
+
+        if image_format is None or len(optimized) >= len(content):
+            return None
+
+        media_type, extension = inx_images.IMAGE_FORMATS[image_format]
+        file_name = item.file_name
+
+        if media_type != item.media_type:
+            file_name = os.path.splitext(item.file_name)[0] + extension
+
+            # Keep the image as it is rather than replace a file of the same name
+            if self.book.get_item_with_href(file_name) is not None:
+                return None
+
+        self.book.items[self.book.items.index(item)] = inx_epub.InxEpubItem(
+            uid=item.id, file_name=file_name, media_type=media_type, content=optimized)
+
+        for key, resource in self.image_resources.items():
+            if resource is not None and resource[1] == item.file_name:
+                self.image_resources[key] = (media_type, file_name)
+
+        self.report.count('images optimized')
+        self.report.count('image bytes saved', len(content) - len(optimized))
+
+        return file_name
+
+    def get_image_resource(self, image, xlink):
+        """Returns a (mime type, relative resource path) tuple for the image file, or None if it can not be used"""
         url = urllib.parse.urlparse(xlink)
         href = urllib.request.url2pathname(str(url.path))
 
         # Primary location always the filename itself.
         path = self.absolute_href(href or '')
+        entry = self.resource_index.get(path)
 
         # Backup directory where we can find the image
-        if not os.path.isfile(path):
+        if entry is None and not os.path.isfile(path):
             path = image.get('sodipodi:absref', path)
+            entry = self.resource_index.get(path)
 
-        if not os.path.isfile(path):
-            inkex.errormsg('File not found "{}". Unable to save and add image.'.format(path))
-            return
+        # Is the image in the resources folder?
+        if entry is None:
+            if not os.path.isfile(path):
+                inkex.errormsg('File not found "{}". Unable to save and add image.'.format(path))
+            else:
+                inkex.utils.debug("save_image_to_epub: image '" + path + "' is not in resource folder, skipping it.")
+            return None
 
         with open(path, "rb") as handle:
             file_type = self.get_image_type(path, handle.read(10))
 
-            # Is the image in the resources folder?
-            if(path.find(resource_folder_path) >= 0):
-                file_name = self.get_relative_resource_path(path)
-            else:
-                inkex.utils.debug("save_image_to_epub: image '"+ path +"' is not in resource folder, skipping it.")
-                handle.close()
-                handle = None
-                return
-
-            handle.seek(0)
-
-            if file_type:
-                # We do not need to do this anymore since I have decided that all resources, including images
-                # must be put in the resources folder and all those have already been added to the EPUB package.
-                # item = inx_epub.InxEpubItem(uid=image.get('id'), file_name=file_name, media_type=file_type, content=handle.read(), create=False)
-                # self.book.add_item(item)
-
-                # Rewrite the urls
-                image.set('sodipodi:absref', file_name)
-                image.set('xlink:href', file_name)
+        if not file_type:
+            inkex.errormsg("%s is not of type image/png, image/jpeg, "
+                           "image/bmp, image/gif, image/tiff, or image/x-icon" % path)
+            return None
 
-            else:
-                inkex.errormsg("%s is not of type image/png, image/jpeg, "
-                               "image/bmp, image/gif, image/tiff, or image/x-icon" % path)
+        return file_type, self.book.get_href(entry.relative_path)
 
     def get_image_type(self, path, header):
         # Basic magic header checker, returns mime type
@@ -600,8 +1450,10 @@ class ExportToEpub(inkex.Effect):
                 return mime
         return None
 
-    def save_images_to_epub(self, element, book):
-        images = element.xpath('//svg:image')
+    def save_images_to_epub(self, element, book, images=None):
+        # All images in the element, if no list of images is given
+        if images is None:
+            images = element.xpath('.//svg:image', namespaces=inkex.NSS)
 
         # make sure that the image hrefs are relative to the "project root"
         for image in images:
@@ -643,7 +1495,9 @@ class ExportToEpub(inkex.Effect):
     #     pass
 
 
-# Create effect instance and apply it.
-effect = ExportToEpub()
+# Create effect instance and apply it. The guard keeps worker processes, which import this file
+# when they are spawned, from running the effect again.
+if __name__ == '__main__':
+    effect = ExportToEpub()
 
-effect.run(output=False)
+    effect.run(output=False)
@@ -0,0 +1,302 @@
+"""
+    MIT License
+
+    Copyright (c) 2020 Lars C Wallin <larscwallin@gmail.com>
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import re
+
+from larscwallin_inx_defs import HREF_ATTRIBUTES, STYLE_TAG, SVG_NAMESPACE, URL_REFERENCE
+
+CC_NAMESPACE = 'http://creativecommons.org/ns#'
+RDF_NAMESPACE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+
+DEFS_TAG = '{%s}defs' % SVG_NAMESPACE
+GROUP_TAG = '{%s}g' % SVG_NAMESPACE
+IMAGE_TAG = '{%s}image' % SVG_NAMESPACE
+METADATA_TAG = '{%s}metadata' % SVG_NAMESPACE
+SCRIPT_TAG = '{%s}script' % SVG_NAMESPACE
+
+# Elements that can set the font of text
+TEXT_TAGS = set('{%s}%s' % (SVG_NAMESPACE, name) for name in (
+    'text', 'tspan', 'textPath', 'flowRoot', 'flowPara', 'flowSpan', 'flowDiv'
+))
+
+# Matches the URL in url(file), url('file') and url("file"), but not url(#id)
+URL_EXTERNAL = re.compile(r'url\(\s*["\']?([^)"\'\s#][^)"\']*)')
+
+# Parsed style attributes. Most elements of a drawing share a handful of styles, so each is only parsed once.
+_styles = {}
+
+
+def parse_style(style):
+    """
+    Returns a dict with the properties of a style attribute. The dict is shared, do not modify it.
+    """
+    properties = _styles.get(style)
+
+    if properties is None:
+        properties = {}
+
+        for declaration in (style or '').split(';'):
+            name, separator, value = declaration.partition(':')
+
+            if separator:
+                properties[name.strip()] = value.strip()
+
+        _styles[style] = properties
+
+    return properties
+
+
+def get_font(node):
+    """
+    Returns a tuple with the font family, weight and style of a text element. Properties that are not set on
+    the element are inherited from the text elements that it is part of.
+    """
+    font = {'font-family': None, 'font-weight': None, 'font-style': None}
+    element = node
+
+    while element is not None and element.tag in TEXT_TAGS:
+        properties = parse_style(element.get('style'))
+
+        for name in font:
+            if font[name] is None:
+                # The style attribute takes precedence over presentation attributes
+                font[name] = properties.get(name) or element.get(name)
+
+        element = element.getparent()
+
+    return font['font-family'], font['font-weight'] or 'normal', font['font-style'] or 'normal'
+
+
+def get_node_references(node):
+    """
+    Returns the ids and the files referenced by the hrefs and CSS url() values of an element, as two lists.
+    """
+    references = []
+    external_references = []
+
+    for name, value in node.attrib.items():
+        if name in HREF_ATTRIBUTES:
+            if value[:1] == '#':
+                references.append(value[1:])
+            elif value[:5] != 'data:':
+                external_references.append(value)
+        elif 'url(' in value:
+            references.extend(URL_REFERENCE.findall(value))
+            external_references.extend(URL_EXTERNAL.findall(value))
+
+    if node.tag == STYLE_TAG and node.text:
+        references.extend(URL_REFERENCE.findall(node.text))
+        external_references.extend(URL_EXTERNAL.findall(node.text))
+
+    return references, external_references
+
+
+class LayerInfo(object):
+    """
+    What the analysis found in a top level layer.
+    """
+
+    def __init__(self, element, visible):
+        self.element = element
+        self.visible = visible
+        # Font families in the order they are first used
+        self.fonts = {}
+        # Font family -> {(font weight, font style): None}, in the order they are first used
+        self.font_styles = {}
+        self.images = []
+        # ids referenced by the layer, and defined in it
+        self.references = set()
+        self.ids = set()
+        # Files referenced by hrefs and CSS url() values in the layer
+        self.external_references = set()
+        self.scripts = 0
+        # Number of elements with event handler attributes, like onclick
+        self.handlers = 0
+        self.element_count = 0
+
+    @property
+    def scripted(self):
+        return self.scripts > 0 or self.handlers > 0
+
+
+class DocumentIndex(object):
+    """
+    Everything the exporter needs to know about the input document, collected in a single walk over the tree.
+
+    Later stages use the index instead of searching the document again: the defs, root scripts and metadata,
+    the top level layers with their fonts, images and references, and the ids of all elements.
+    """
+
+    def __init__(self, document):
+        """
+        :Args:
+          - document: root element of the document
+        """
+        self.root = document
+        self.defs = []
+        self.scripts = []
+        self.metadata = None
+        self.layers = []
+        # Font families of all text in the document, in the order they are first used
+        self.fonts = {}
+        # Font family -> {(font weight, font style): None}, in the order they are first used
+        self.font_styles = {}
+        # The same for text outside of the layers, like text in defs, that any page can use
+        self.shared_font_styles = {}
+        # Text elements that set a font family of their own
+        self.font_elements = []
+        # (font family, font weight, font style) -> set of the characters of the text set in that font
+        self.font_text = {}
+        # Image elements outside of the layers, like in defs
+        self.shared_images = []
+        # ids and files referenced by hrefs and CSS url() values outside of the layers
+        self.shared_references = set()
+        self.shared_external_references = set()
+        # Number of style elements. Their rules can override presentation attributes.
+        self.style_elements = 0
+        # The style elements, whose rules can set font families
+        self.styles = []
+        # id -> element, for every element in the document
+        self.elements = {}
+        # element -> position in the document, for the elements in self.elements
+        self.order = {}
+        self.element_count = 0
+
+        self._walk()
+
+    @property
+    def visible_layers(self):
+        return [layer for layer in self.layers if layer.visible]
+
+    def get_referenced_ids(self):
+        """
+        Returns the set of the ids referenced anywhere in the document.
+        """
+        references = set(self.shared_references)
+
+        for layer in self.layers:
+            references.update(layer.references)
+
+        return references
+
+    def _walk(self):
+        position = 0
+
+        self._add_element(self.root, position, None)
+
+        for child in self.root:
+            if not isinstance(child.tag, str):
+                continue
+
+            layer = None
+
+            if child.tag == GROUP_TAG:
+                visible = 'display:none' not in (child.get('style') or '')
+                layer = LayerInfo(child, visible)
+                self.layers.append(layer)
+            elif child.tag == DEFS_TAG:
+                self.defs.append(child)
+            elif child.tag == SCRIPT_TAG:
+                self.scripts.append(child)
+            elif child.tag == METADATA_TAG and self.metadata is None:
+                self.metadata = child.find('{%s}RDF/{%s}Work' % (RDF_NAMESPACE, CC_NAMESPACE))
+
+            for node in child.iter():
+                position += 1
+
+                if isinstance(node.tag, str):
+                    self._add_element(node, position, layer)
+
+    def _add_element(self, node, position, layer):
+        self.element_count += 1
+
+        node_id = node.get('id')
+
+        if node_id is not None and node_id not in self.elements:
+            self.elements[node_id] = node
+            self.order[node] = position
+
+        if node.tag in TEXT_TAGS:
+            font, weight, style = get_font(node)
+
+            if font:
+                # The tails of child elements are text of this element
+                characters = self.font_text.setdefault((font, weight, style), set())
+                characters.update(node.text or '')
+                for child in node:
+                    characters.update(child.tail or '')
+
+                self.fonts.setdefault(font, font)
+                self.font_styles.setdefault(font, {}).setdefault((weight, style))
+                if layer is not None:
+                    layer.fonts.setdefault(font, font)
+                    layer.font_styles.setdefault(font, {}).setdefault((weight, style))
+                else:
+                    self.shared_font_styles.setdefault(font, {}).setdefault((weight, style))
+
+            if 'font-family' in parse_style(node.get('style')) or node.get('font-family') is not None:
+                self.font_elements.append(node)
+
+        if node.tag == STYLE_TAG:
+            self.style_elements += 1
+            self.styles.append(node)
+
+        if layer is None:
+            if node.tag == IMAGE_TAG:
+                self.shared_images.append(node)
+
+            references, external_references = get_node_references(node)
+            self.shared_references.update(references)
+            self.shared_external_references.update(external_references)
+            return
+
+        layer.element_count += 1
+
+        if node_id is not None:
+            layer.ids.add(node_id)
+
+        handler = False
+
+        for name, value in node.attrib.items():
+            if name in HREF_ATTRIBUTES:
+                if value[:1] == '#':
+                    layer.references.add(value[1:])
+                elif value[:5] != 'data:':
+                    layer.external_references.add(value)
+            elif 'url(' in value:
+                layer.references.update(URL_REFERENCE.findall(value))
+                layer.external_references.update(URL_EXTERNAL.findall(value))
+            elif name[:2] == 'on':
+                handler = True
+
+        if handler:
+            layer.handlers += 1
+
+        if node.tag == IMAGE_TAG:
+            layer.images.append(node)
+        elif node.tag == SCRIPT_TAG:
+            layer.scripts += 1
+        elif node.tag == STYLE_TAG and node.text:
+            layer.references.update(URL_REFERENCE.findall(node.text))
+            layer.external_references.update(URL_EXTERNAL.findall(node.text))
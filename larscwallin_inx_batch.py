@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+"""
+    MIT License
+
+    Copyright (c) 2020 Lars C Wallin <larscwallin@gmail.com>
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+"""
+Headless batch export, without launching Inkscape.
+
+Export a few files, using the same options as the extension:
+
+    python larscwallin_inx_batch.py --where=out --root_folder=book --resources_folder=resources book/*.svg
+
+Or run the jobs in a manifest, and write a summary of the timings:
+
+    python larscwallin_inx_batch.py --manifest nightly.json --workers 8 --summary summary.json
+
+A manifest is a JSON file like this. Options given on the command line are used as defaults for all jobs:
+
+    {
+        "defaults": {"where": "out", "wrap_svg_in_html": true},
+        "jobs": [
+            {"svg": "book-1/book.svg", "options": {"root_folder": "book-1", "filename": "book-1.epub"}},
+            {"svg": "book-2/book.svg", "options": {"root_folder": "book-2", "filename": "book-2.epub"}}
+        ]
+    }
+
+The paths in a manifest, the SVG files and the root_folder, where and cache_folder options, are relative to the
+manifest, so it works the same from any folder. The resources_folder is relative to the root folder, which is the
+folder of the manifest unless the manifest or the command line sets one.
+
+The same can be done from Python:
+
+    >>> import larscwallin_inx_batch as batch
+    >>> batch.export('book.svg', {'where': 'out', 'filename': 'book.epub'})
+    >>> batch.export_batch([{'svg': 'book.svg', 'options': {...}}], workers=8)
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+EXPORTER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'larscwallin.inx.exporttoepub.py')
+
+# Options that are paths. In a manifest they are relative to the manifest.
+PATH_OPTIONS = ('root_folder', 'where', 'cache_folder')
+
+# The extension module, loaded once per process by load_exporter()
+_exporter_module = None
+
+
+def load_exporter():
+    """
+    Returns the ExportToEpub class. The extension file name is not a valid module name so it is loaded from its path.
+    """
+    global _exporter_module
+
+    if _exporter_module is None:
+        spec = importlib.util.spec_from_file_location('larscwallin_inx_exporttoepub', EXPORTER_PATH)
+        _exporter_module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(_exporter_module)
+
+    return _exporter_module.ExportToEpub
+
+
+def get_arguments(svg, options):
+    """
+    Returns the command line arguments for the extension. Options is a dict with the same names as the extension
+    arguments, without the leading dashes.
+    """
+    arguments = []
+
+    for name, value in sorted(options.items()):
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+
+        arguments.append('--%s=%s' % (name, value))
+
+    arguments.append(svg)
+
+    return arguments
+
+
+def export(svg, options=None):
+    """
+    Exports a single SVG file to EPUB.
+
+    :Args:
+      - svg: path to the SVG file
+      - options: dict of extension options, like {'where': 'out', 'filename': 'book.epub'}
+
+    :Returns:
+      dict with the 'svg', 'epub' path, 'exit_code' (0 on success), 'error' message and 'seconds' of the job
+    """
+    options = dict(options or {})
+    start = time.time()
+    result = {
+        'svg': svg,
+        'epub': os.path.join(options.get('where', ''), options.get('filename', 'publication.epub')),
+        'exit_code': 0,
+        'error': None,
+        'seconds': 0.0
+    }
+
+    try:
+        effect = load_exporter()()
+        # The extension does not output a changed SVG, but inkex writes one if the document was touched
+        effect.run(get_arguments(svg, options), output=os.devnull)
+    except SystemExit as err:
+        if err.code not in (None, 0):
+            result['exit_code'] = err.code if isinstance(err.code, int) else 1
+            result['error'] = 'Exited with status %s' % err.code
+    except Exception as err:
+        result['exit_code'] = 1
+        result['error'] = ''.join(traceback.format_exception_only(type(err), err)).strip()
+        traceback.print_exc()
+
+    result['seconds'] = time.time() - start
+
+    return result
+
+
+def _export_job(job):
+    return export(job['svg'], job.get('options'))
+
+
+def export_batch(jobs, workers=0, defaults=None):
+    """
+    Exports many SVG files, in a pool of worker processes.
+
+    :Args:
+      - jobs: list of dicts with the 'svg' path and optional 'options' of each job
+      - workers: number of worker processes. 0 uses all available CPUs.
+      - defaults: dict of options used for all jobs. Options of a job take precedence.
+
+    :Returns:
+      List of result dicts, see export(), in the same order as the jobs
+    """
+    prepared = []
+
+    for job in jobs:
+        options = dict(defaults or {})
+        options.update(job.get('options') or {})
+
+        # Each job gets a worker of its own, so by default layers are not rendered in yet another pool
+        options.setdefault('jobs', 1)
+
+        prepared.append({'svg': job['svg'], 'options': options})
+
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    workers = min(workers, len(prepared))
+
+    if workers <= 1:
+        return [_export_job(job) for job in prepared]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_export_job, prepared))
+
+
+def read_manifest(path):
+    """
+    Returns a (jobs, defaults) tuple read from a JSON manifest. The manifest is either a list of jobs or a dict with
+    'jobs' and optional 'defaults'. Relative paths to SVG files and in path options are relative to the manifest.
+    """
+    with open(path, 'r') as handle:
+        manifest = json.load(handle)
+
+    if isinstance(manifest, list):
+        manifest = {'jobs': manifest}
+
+    folder = os.path.dirname(os.path.abspath(path))
+    jobs = []
+
+    for job in manifest.get('jobs', []):
+        if not isinstance(job, dict):
+            job = {'svg': job}
+
+        job = dict(job)
+        job['svg'] = os.path.join(folder, job['svg'])
+        if job.get('options'):
+            job['options'] = resolve_path_options(job['options'], folder)
+        jobs.append(job)
+
+    defaults = resolve_path_options(manifest.get('defaults', {}), folder)
+    defaults.setdefault('root_folder', folder)
+
+    return jobs, defaults
+
+
+def resolve_path_options(options, folder):
+    """
+    Returns a copy of options with the relative paths in PATH_OPTIONS made relative to folder.
+    """
+    options = dict(options)
+
+    for name in PATH_OPTIONS:
+        value = options.get(name)
+        if isinstance(value, str) and value != '':
+            options[name] = os.path.join(folder, os.path.expanduser(value))
+
+    return options
+
+
+def parse_option_arguments(arguments):
+    """
+    Turns extension arguments like --where=out into a dict of options.
+    """
+    options = {}
+    pending = None
+
+    for argument in arguments:
+        if argument.startswith('--'):
+            name, separator, value = argument[2:].partition('=')
+
+            if separator:
+                options[name] = value
+                pending = None
+            else:
+                options[name] = 'true'
+                pending = name
+        elif pending is not None:
+            options[pending] = argument
+            pending = None
+        else:
+            raise ValueError('Unexpected argument "%s"' % argument)
+
+    return options
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export Inkscape SVG files to EPUB3 without launching Inkscape. '
+                                                 'Any other --name=value arguments are passed on to the exporter.')
+    parser.add_argument('svg', nargs='*', help='SVG files to export')
+    parser.add_argument('--manifest', help='JSON file with the jobs to run')
+    parser.add_argument('--workers', type=int, default=0, help='Number of worker processes. 0 uses all CPUs.')
+    parser.add_argument('--summary', help='Write a JSON summary of the results and timings to this file')
+
+    args, extra = parser.parse_known_args(argv)
+
+    try:
+        defaults = parse_option_arguments(extra)
+    except ValueError as err:
+        parser.error(str(err))
+
+    jobs = [{'svg': svg} for svg in args.svg]
+
+    if args.manifest:
+        manifest_jobs, manifest_defaults = read_manifest(args.manifest)
+        manifest_defaults.update(defaults)
+        defaults = manifest_defaults
+        jobs += manifest_jobs
+
+    if len(jobs) == 0:
+        parser.error('No SVG files or manifest given')
+
+    start = time.time()
+    results = export_batch(jobs, args.workers, defaults)
+    seconds = time.time() - start
+
+    failed = [result for result in results if result['exit_code'] != 0]
+
+    for result in results:
+        sys.stdout.write('%-6s %8.2fs  %s -> %s\n' % ('ok' if result['exit_code'] == 0 else 'FAILED',
+                                                      result['seconds'], result['svg'], result['epub']))
+
+    sys.stdout.write('%d of %d jobs succeeded in %.2fs\n' % (len(results) - len(failed), len(results), seconds))
+
+    if args.summary:
+        with open(args.summary, 'w') as handle:
+            json.dump({'seconds': seconds, 'succeeded': len(results) - len(failed), 'failed': len(failed),
+                       'jobs': results}, handle, indent=2)
+
+    return 1 if len(failed) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+
+"""
+    MIT License
+
+    Copyright (c) 2020 Lars C Wallin <larscwallin@gmail.com>
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+"""
+Benchmark of the exporter on generated documents.
+
+Each run generates an Inkscape document with the given number of layers, paths, defs, fonts, images and scripts,
+exports it and times each stage of the export separately. Everything is generated locally, nothing is downloaded.
+
+    python larscwallin_inx_benchmark.py --layers 10,100,500,2000 --output results.json
+
+The results are written as JSON, one entry per run, with the parameters of the run and the seconds and number
+of calls of each stage. Layers are rendered in this process so that the stages can be timed.
+"""
+
+import argparse
+import base64
+import contextlib
+import functools
+import json
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+import larscwallin_inx_batch as inx_batch
+import larscwallin_inx_defs as inx_defs
+import larscwallin_inx_ebooklib_epub as inx_epub
+import larscwallin_inx_optimize as inx_optimize
+import larscwallin_inx_pipeline as inx_pipeline
+import larscwallin_inx_resources as inx_resources
+
+DEFAULT_PARAMETERS = {
+    'layers': 10,
+    'paths': 20,
+    'defs': 20,
+    'fonts': 2,
+    'images': 2,
+    'embedded_images': 0,
+    'scripts': 1,
+    'seed': 1
+}
+
+# Stage name -> (owner, attribute) of the function that is timed. The owner 'effect' is the exporter instance.
+STAGES = [
+    ('resource scan', inx_resources.ResourceIndex, '_scan'),
+    ('resources', 'effect', 'add_resources'),
+    ('font resolution', 'effect', 'resolve_fonts'),
+    ('embedded images', 'effect', 'save_embedded_images'),
+    ('hidden content', inx_optimize, 'remove_hidden_elements'),
+    ('images', 'effect', 'save_images_to_epub'),
+    ('defs', inx_defs.DefsIndex, 'get_defs_string'),
+    ('templating', inx_pipeline, 'fill_template'),
+    ('parse', inx_optimize, 'parse_page'),
+    ('optimize', inx_optimize, 'optimize_page'),
+    ('serialize', inx_optimize, 'serialize_page'),
+    ('scour', inx_pipeline, 'scour_doc'),
+    ('reparse', inx_pipeline, 'reparse_doc'),
+    ('epub write', inx_epub, 'write_epub')
+]
+
+FONT_FAMILIES = ['Open Sans', 'Lato', 'Roboto Slab', 'Source Serif Pro', 'Fira Sans', 'Merriweather', 'Noto Sans',
+                 'Playfair Display']
+
+
+class StageTimer(object):
+    """
+    Times the calls to a set of functions by temporarily replacing them with timing wrappers.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.active = set()
+        self.replaced = []
+
+    def wrap(self, stage, owner, name):
+        function = getattr(owner, name)
+        timer = self
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            # Recursive calls, like add_resources for sub folders, are part of the outer call
+            if stage in timer.active:
+                return function(*args, **kwargs)
+
+            timer.active.add(stage)
+            start = time.perf_counter()
+
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timer.seconds[stage] = timer.seconds.get(stage, 0.0) + time.perf_counter() - start
+                timer.calls[stage] = timer.calls.get(stage, 0) + 1
+                timer.active.discard(stage)
+
+        # Remember whether the attribute belonged to the owner itself, or was looked up through its class
+        self.replaced.append((owner, name, owner.__dict__.get(name)))
+        setattr(owner, name, wrapper)
+
+    def restore(self):
+        for owner, name, original in reversed(self.replaced):
+            if original is None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, original)
+
+        self.replaced = []
+
+
+def make_png(width, height, color):
+    """
+    Returns a PNG image of a single color.
+    """
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    row = b'\x00' + bytes(color) * width
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(row * height)) +
+            chunk(b'IEND', b''))
+
+
+def generate_document(folder, layers=10, paths=20, defs=20, fonts=2, images=2, embedded_images=0, scripts=1, seed=1):
+    """
+    Writes a generated document and its resources to folder.
+
+    :Args:
+      - folder: folder to write to. The document is written to folder/document.svg and the fonts and images
+        to folder/resources.
+      - layers: number of top level layers
+      - paths: number of paths per layer
+      - defs: number of gradients in the defs. Each layer uses a few of them.
+      - fonts: number of font families. Each layer has a text in one of them.
+      - images: number of linked images per layer
+      - embedded_images: number of images per layer embedded as data: URIs
+      - scripts: number of scripts in the document root
+      - seed: seed of the random numbers, the same parameters and seed give the same document
+
+    :Returns:
+      Path to the document
+    """
+    rng = random.Random(seed)
+    resources = os.path.join(folder, 'resources')
+    os.makedirs(os.path.join(resources, 'fonts'), exist_ok=True)
+    os.makedirs(os.path.join(resources, 'images'), exist_ok=True)
+
+    families = [FONT_FAMILIES[index % len(FONT_FAMILIES)] + ('' if index < len(FONT_FAMILIES) else ' %d' % index)
+                for index in range(fonts)]
+
+    # The fonts are not real fonts. The exporter can not read their names, so it finds them by file name, the
+    # same way as any font that it can not read.
+    for family in families:
+        with open(os.path.join(resources, 'fonts', family.replace(' ', '+') + '-Regular.ttf'), 'wb') as handle:
+            handle.write(os.urandom(32 * 1024))
+
+    image_paths = []
+    for index in range(max(images, 1)):
+        path = os.path.join(resources, 'images', 'image-%d.png' % index)
+        with open(path, 'wb') as handle:
+            handle.write(make_png(64, 64, (rng.randrange(256), rng.randrange(256), rng.randrange(256))))
+        image_paths.append(path)
+
+    embedded_png = base64.b64encode(make_png(32, 32, (200, 100, 50))).decode('ascii')
+
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8" standalone="no"?>',
+        '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+        'xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" '
+        'xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd" '
+        'xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:cc="http://creativecommons.org/ns#" '
+        'xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" '
+        'width="210mm" height="297mm" viewBox="0 0 210 297" version="1.1" id="document">',
+        '<metadata id="metadata"><rdf:RDF><cc:Work rdf:about="">'
+        '<dc:title>Benchmark %d layers</dc:title><dc:language>en</dc:language>'
+        '</cc:Work></rdf:RDF></metadata>' % layers,
+        '<defs id="defs">'
+    ]
+
+    for index in range(defs):
+        lines.append('<linearGradient id="gradient-%d" x1="0" y1="0" x2="1" y2="1">'
+                     '<stop offset="0" style="stop-color:#%06x"/><stop offset="1" style="stop-color:#%06x"/>'
+                     '</linearGradient>' % (index, rng.randrange(0xffffff), rng.randrange(0xffffff)))
+
+    lines.append('</defs>')
+
+    for index in range(scripts):
+        lines.append('<script id="script-%d">var counter%d = 0;\nfunction tick%d() { counter%d += 1; }</script>'
+                     % (index, index, index, index))
+
+    for layer in range(layers):
+        lines.append('<g inkscape:groupmode="layer" inkscape:label="Page %d" id="layer-%d">' % (layer + 1, layer))
+
+        for index in range(paths):
+            points = ' '.join('%.3f,%.3f' % (rng.uniform(0, 210), rng.uniform(0, 297)) for point in range(6))
+            fill = 'url(#gradient-%d)' % rng.randrange(defs) if defs > 0 else '#%06x' % rng.randrange(0xffffff)
+            lines.append('<path id="path-%d-%d" d="M %s Z" style="fill:%s;stroke:#000000;stroke-width:0.26"/>'
+                         % (layer, index, points, fill))
+
+        if fonts > 0:
+            family = families[layer % fonts]
+            lines.append('<text id="text-%d" x="20" y="40" style="font-size:12px;font-family:\'%s\'">'
+                         '<tspan id="tspan-%d" x="20" y="40">Page %d set in %s</tspan></text>'
+                         % (layer, family, layer, layer + 1, family))
+
+        for index in range(images):
+            path = image_paths[(layer + index) % len(image_paths)]
+            lines.append('<image id="image-%d-%d" x="%d" y="200" width="40" height="40" xlink:href="%s" '
+                         'sodipodi:absref="%s"/>' % (layer, index, 10 + index * 45, path, path))
+
+        for index in range(embedded_images):
+            lines.append('<image id="embedded-%d-%d" x="%d" y="250" width="32" height="32" '
+                         'xlink:href="data:image/png;base64,%s"/>' % (layer, index, 10 + index * 40, embedded_png))
+
+        lines.append('</g>')
+
+    lines.append('</svg>')
+
+    path = os.path.join(folder, 'document.svg')
+    with open(path, 'w') as handle:
+        handle.write('\n'.join(lines))
+
+    return path
+
+
+def run_benchmark(folder, parameters, optimizer='tree', verbose=False):
+    """
+    Generates a document in folder, exports it with the given optimizer and returns the result of the run as a dict.
+    The cache folder of the export, with the font catalog, is also in folder, so that every run starts from an
+    empty cache and nothing is left behind in the user cache folder.
+    """
+    svg_path = generate_document(folder, **parameters)
+
+    effect = inx_batch.load_exporter()()
+    effect.parse_arguments(['--where=' + folder, '--root_folder=' + folder, '--resources_folder=resources',
+                            '--filename=benchmark.epub', '--jobs=1', '--build_report=false', '--strip_hidden=true',
+                            '--cache_folder=' + os.path.join(folder, 'cache'),
+                            '--optimizer=' + optimizer, svg_path])
+
+    timer = StageTimer()
+    start = time.perf_counter()
+
+    with open(os.devnull, 'w') as devnull:
+        output = contextlib.nullcontext() if verbose else contextlib.redirect_stderr(devnull)
+
+        with output:
+            effect.load_raw()
+            load_seconds = time.perf_counter() - start
+
+            for stage, owner, name in STAGES:
+                timer.wrap(stage, effect if owner == 'effect' else owner, name)
+
+            try:
+                effect.effect()
+            finally:
+                timer.restore()
+                effect.clean_up()
+
+    total = time.perf_counter() - start
+    stages = {'load': {'seconds': load_seconds, 'calls': 1}}
+
+    for stage, owner, name in STAGES:
+        stages[stage] = {'seconds': timer.seconds.get(stage, 0.0), 'calls': timer.calls.get(stage, 0)}
+
+    stages['other'] = {'seconds': max(total - sum(values['seconds'] for values in stages.values()), 0.0),
+                       'calls': 1}
+
+    return {
+        'parameters': parameters,
+        'optimizer': optimizer,
+        'svg_bytes': os.path.getsize(svg_path),
+        'epub_bytes': os.path.getsize(os.path.join(folder, 'benchmark.epub')),
+        'seconds': total,
+        'stages': stages
+    }
+
+
+def parse_counts(value):
+    return [int(count) for count in value.split(',') if count.strip() != '']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the exporter on generated documents. '
+                                                 'Every combination of the comma separated counts is run.')
+
+    for name, default in sorted(DEFAULT_PARAMETERS.items()):
+        if name != 'seed':
+            parser.add_argument('--' + name, type=parse_counts, default=[default],
+                                help='Comma separated list of counts (default %d)' % default)
+
+    parser.add_argument('--seed', type=int, default=DEFAULT_PARAMETERS['seed'], help='Seed of the random numbers')
+    parser.add_argument('--optimizer', default='tree', choices=('tree', 'scour'), help='Optimizer of the exporter')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of times each combination is run')
+    parser.add_argument('--output', help='Write the results as JSON to this file instead of stdout')
+    parser.add_argument('--keep', help='Generate the documents in this folder and keep them')
+    parser.add_argument('--verbose', action='store_true', help='Show the messages of the exporter')
+
+    args = parser.parse_args(argv)
+
+    combinations = [{'seed': args.seed}]
+    for name in sorted(DEFAULT_PARAMETERS):
+        if name != 'seed':
+            combinations = [dict(combination, **{name: count})
+                            for combination in combinations for count in getattr(args, name)]
+
+    results = []
+
+    for number, parameters in enumerate(combinations):
+        for repeat in range(args.repeat):
+            if args.keep:
+                folder = os.path.join(args.keep, 'run-%d-%d' % (number, repeat))
+                os.makedirs(folder, exist_ok=True)
+                result = run_benchmark(folder, parameters, args.optimizer, args.verbose)
+            else:
+                with tempfile.TemporaryDirectory(prefix='inx-benchmark-') as folder:
+                    result = run_benchmark(folder, parameters, args.optimizer, args.verbose)
+
+            result['repeat'] = repeat
+            results.append(result)
+
+            sys.stderr.write('%5d layers %8.2fs  %s\n' % (
+                parameters['layers'], result['seconds'],
+                '  '.join('%s %.2fs' % (stage, values['seconds']) for stage, values in result['stages'].items())))
+
+    report = json.dumps({'python': sys.version.split()[0], 'results': results}, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as handle:
+            handle.write(report)
+    else:
+        sys.stdout.write(report + '\n')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
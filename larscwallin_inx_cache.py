@@ -0,0 +1,165 @@
+"""
+    MIT License
+
+    Copyright (c) 2020 Lars C Wallin <larscwallin@gmail.com>
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import hashlib
+import os
+import tempfile
+
+
+class LayerCache(object):
+    """
+    On-disk cache of finished layer documents.
+
+    Entries are stored as one file per key in a two level folder structure below the cache folder. Files are
+    written to a temporary name and then renamed into place, so several exports can share the same folder
+    without ever reading a half written entry. The modification time of an entry is updated on every hit and
+    is used to evict the least recently used entries when the cache grows beyond max_size.
+    """
+
+    # Bump this whenever a change in the exporter changes the documents it produces
+    VERSION = '1'
+
+    def __init__(self, folder, max_size=512 * 1024 * 1024):
+        """
+        :Args:
+          - folder: Folder where the cache entries are stored. Created if it does not exist.
+          - max_size: Maximum total size of all entries in bytes
+        """
+        self.folder = folder
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.folder, exist_ok=True)
+
+    def make_key(self, *parts):
+        """
+        Returns a key for the given parts. Parts are str, bytes or anything that can be turned into a str.
+        """
+        digest = hashlib.sha256(self.VERSION.encode('utf-8'))
+
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = str(part).encode('utf-8')
+
+            # Length prefix each part so that ('ab', 'c') and ('a', 'bc') give different keys
+            digest.update(str(len(part)).encode('ascii') + b':')
+            digest.update(part)
+
+        return digest.hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.folder, key[:2], key)
+
+    def get(self, key):
+        """
+        Returns the cached content for key as bytes, or None if there is no such entry.
+        """
+        path = self._get_path(key)
+
+        try:
+            with open(path, 'rb') as handle:
+                content = handle.read()
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+
+        try:
+            # Mark the entry as recently used
+            os.utime(path, None)
+        except OSError:
+            # Evicted by another export in the mean time, the content we read is still valid
+            pass
+
+        self.hits += 1
+        return content
+
+    def put(self, key, content):
+        """
+        Stores content (bytes) under key.
+        """
+        path = self._get_path(key)
+        folder = os.path.dirname(path)
+
+        os.makedirs(folder, exist_ok=True)
+
+        handle, temp_path = tempfile.mkstemp(dir=folder, prefix='.tmp-')
+
+        try:
+            with os.fdopen(handle, 'wb') as temp_file:
+                temp_file.write(content)
+
+            os.replace(temp_path, path)
+        except (IOError, OSError):
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    def trim(self):
+        """
+        Removes the least recently used entries until the total size of the cache is below max_size.
+
+        :Returns:
+          Number of removed entries
+        """
+        entries = []
+        total_size = 0
+
+        for shard in os.scandir(self.folder):
+            if not shard.is_dir():
+                continue
+
+            for entry in os.scandir(shard.path):
+                # Skip temporary files that are being written by other exports
+                if entry.name.startswith('.tmp-'):
+                    continue
+
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+        removed = 0
+
+        if total_size > self.max_size:
+            entries.sort()
+
+            for mtime, size, path in entries:
+                if total_size <= self.max_size:
+                    break
+
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    # Already removed by another export
+                    pass
+
+                total_size -= size
+
+        return removed
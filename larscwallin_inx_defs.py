@@ -0,0 +1,234 @@
+"""
+    MIT License
+
+    Copyright (c) 2020 Lars C Wallin <larscwallin@gmail.com>
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import copy
+import re
+
+from lxml import etree
+
+SVG_NAMESPACE = 'http://www.w3.org/2000/svg'
+XLINK_NAMESPACE = 'http://www.w3.org/1999/xlink'
+
+HREF_ATTRIBUTES = ('{%s}href' % XLINK_NAMESPACE, 'href')
+STYLE_TAG = '{%s}style' % SVG_NAMESPACE
+
+# Defs children that apply without being referenced by id, like style sheets and SVG fonts. Every page gets them.
+UNREFERENCED_TAGS = set('{%s}%s' % (SVG_NAMESPACE, tag) for tag in ('style', 'font', 'font-face', 'script', 'title',
+                                                                     'desc'))
+
+# Matches the id in url(#id), url('#id') and url("#id")
+URL_REFERENCE = re.compile(r'url\(\s*["\']?#([^)"\'\s]+)')
+
+
+def get_references(element):
+    """
+    Returns a tuple with the set of ids referenced by the element and its descendants, and the set
+    of ids defined by them.
+    """
+    references = set()
+    ids = set()
+
+    for node in element.iter():
+        # Skip comments and processing instructions
+        if not isinstance(node.tag, str):
+            continue
+
+        node_id = node.get('id')
+        if node_id is not None:
+            ids.add(node_id)
+
+        for name, value in node.attrib.items():
+            if name in HREF_ATTRIBUTES:
+                if value[:1] == '#':
+                    references.add(value[1:])
+            elif 'url(' in value:
+                references.update(URL_REFERENCE.findall(value))
+
+        if node.tag == STYLE_TAG and node.text:
+            references.update(URL_REFERENCE.findall(node.text))
+
+    return references, ids
+
+
+class DefsIndex(object):
+    """
+    Dependency index over the defs of a document.
+
+    The index is built once per export and is used to give each page only the defs that it actually
+    uses, following references transitively. Elements referenced by a page but defined outside of the
+    defs, for instance in another layer, are copied into the defs of the page. Defs that can not be
+    referenced, like style sheets and SVG fonts, and the defs that their CSS references, go into every page.
+    """
+
+    def __init__(self, document, defs, elements=None, order=None):
+        """
+        :Args:
+          - document: root element of the document
+          - defs: list of the svg:defs elements that are shared by all pages
+          - elements: optional dict of id -> element for the whole document, like DocumentIndex.elements
+          - order: optional dict of element -> position in the document, for the elements in elements
+        """
+        self.defs = defs
+
+        # id -> element, for every element in the document
+        self.elements = elements if elements is not None else {}
+        # element -> position in the document, for the elements in self.elements
+        self.order = order if order is not None else {}
+        # id -> the top level child of a defs element that defines it
+        self.definitions = {}
+        # element -> ids referenced by the element, filled on demand
+        self.references = {}
+        # Defs children that every page gets: the ones that apply without being referenced, and the defs that
+        # they or the style elements in the document root reference, like the gradients used by CSS rules
+        self.shared = set()
+
+        if elements is None:
+            for index, element in enumerate(document.iter()):
+                if isinstance(element.tag, str):
+                    element_id = element.get('id')
+                    if element_id is not None and element_id not in self.elements:
+                        self.elements[element_id] = element
+                        self.order[element] = index
+
+        pending = []
+
+        for defs_element in self.defs:
+            for child in defs_element:
+                if child.tag in UNREFERENCED_TAGS:
+                    self.shared.add(child)
+                    pending.extend(self._get_references(child))
+
+                for node in child.iter():
+                    if isinstance(node.tag, str) and node.get('id') is not None:
+                        self.definitions.setdefault(node.get('id'), child)
+
+        for child in document:
+            if child.tag == STYLE_TAG and child.text:
+                pending.extend(URL_REFERENCE.findall(child.text))
+
+        # Only defs are followed from here, elements in the layers are not copied into every page
+        while len(pending) > 0:
+            child = self.definitions.get(pending.pop())
+
+            if child is not None and child not in self.shared:
+                self.shared.add(child)
+                pending.extend(self._get_references(child))
+
+    def _get_references(self, element):
+        if element not in self.references:
+            self.references[element] = get_references(element)[0]
+
+        return self.references[element]
+
+    def resolve(self, layer, references=None):
+        """
+        Returns a tuple with the set of defs children used by the layer and a list of the elements
+        outside of the defs that it references, in document order.
+
+        :Args:
+          - layer: the layer element
+          - references: optional tuple with the ids referenced by the layer and the ids defined in it, like
+            get_references() returns. Found by walking the layer if not given.
+        """
+        pending, layer_ids = references if references is not None else get_references(layer)
+        pending = list(pending)
+        layer_ancestors = set(layer.iterancestors())
+        seen = set()
+        included = set(self.shared)
+        foreign = []
+
+        while len(pending) > 0:
+            reference = pending.pop()
+
+            if reference in seen:
+                continue
+
+            seen.add(reference)
+
+            child = self.definitions.get(reference)
+
+            if child is not None:
+                if child not in included:
+                    included.add(child)
+                    pending.extend(self._get_references(child))
+                continue
+
+            # Elements in the layer itself are already part of the page
+            if reference in layer_ids:
+                continue
+
+            element = self.elements.get(reference)
+
+            # References to the document itself, or to a group containing the layer, can not be copied
+            if element is not None and element not in layer_ancestors:
+                foreign.append(element)
+                pending.extend(self._get_references(element))
+
+        # An element that is copied along with one of its ancestors should not be copied twice
+        foreign_set = set(foreign)
+        foreign = [element for element in foreign
+                   if not any(ancestor in foreign_set for ancestor in element.iterancestors())]
+
+        # Keep the document order so that the output does not depend on the order of the references
+        foreign.sort(key=lambda element: self.order[element])
+
+        return included, foreign
+
+    def get_defs_string(self, layer, references=None):
+        """
+        Returns the serialized defs needed by the layer. See resolve() for the arguments.
+
+        The defs and foreign elements are copied as they are when this is called, so hrefs in them, like those of
+        images, must already be rewritten for the EPUB, also when the element belongs to a later layer.
+        """
+        included, foreign = self.resolve(layer, references)
+        defs_string = ''
+        subsets = []
+
+        for defs_element in self.defs:
+            subset = etree.Element(defs_element.tag, attrib=dict(defs_element.attrib), nsmap=defs_element.nsmap)
+            subset.text = defs_element.text
+
+            for child in defs_element:
+                if child in included:
+                    subset.append(copy.deepcopy(child))
+
+            subsets.append(subset)
+
+        if len(foreign) > 0:
+            if len(subsets) == 0:
+                subsets.append(etree.Element('{%s}defs' % SVG_NAMESPACE, nsmap={None: SVG_NAMESPACE}))
+
+            for element in foreign:
+                element_copy = copy.deepcopy(element)
+                element_copy.tail = None
+                subsets[0].append(element_copy)
+
+        if len(subsets) > 0:
+            for subset in subsets:
+                defs_string += str(etree.tostring(subset, method='html', pretty_print=False), 'utf-8')
+        else:
+            defs_string = '<defs/>'
+
+        return defs_string
@@ -13,7 +13,17 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with EbookLib.  If not, see <http://www.gnu.org/licenses/>.
+import collections
+import functools
+import hashlib
+import os
+import shutil
+import struct
 import sys
+import tempfile
+import time
+import zipfile
+import zlib
 
 sys.path.append('./ebooklib')
 
@@ -25,17 +35,196 @@ try:
 except ImportError:
     from urllib import unquote
 
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
 from lxml import etree
 
+try:
+    # Optional, used by the 'max' compression profile
+    import zopfli.zlib
+except ImportError:
+    zopfli = None
+
 import ebooklib
 
 from ebooklib.utils import parse_string, parse_html_string
 
+import larscwallin_inx_pipeline as inx_pipeline
+
+# Size of the chunks used when file backed items are copied into the EPUB
+FILE_CHUNK_SIZE = 1024 * 1024
+# Compressed files larger than this are kept in a temporary file until they are written to the EPUB
+SPOOL_SIZE = 4 * 1024 * 1024
+
+# How entries are stored in the EPUB, by media type. Formats that are already compressed gain next to nothing
+# from being deflated again, so they are stored as they are. Media types that are not listed are deflated, or
+# sampled first when the sample_compression option is set.
+COMPRESSION_POLICY = {
+    'image/jpeg': zipfile.ZIP_STORED,
+    'image/png': zipfile.ZIP_STORED,
+    'image/gif': zipfile.ZIP_STORED,
+    'image/webp': zipfile.ZIP_STORED,
+    'font/woff': zipfile.ZIP_STORED,
+    'font/woff2': zipfile.ZIP_STORED,
+    'application/font-woff': zipfile.ZIP_STORED,
+    'application/font-woff2': zipfile.ZIP_STORED,
+    'audio/mpeg': zipfile.ZIP_STORED,
+    'audio/mp4': zipfile.ZIP_STORED,
+    'audio/ogg': zipfile.ZIP_STORED,
+    'video/mp4': zipfile.ZIP_STORED,
+    'video/webm': zipfile.ZIP_STORED,
+    'application/zip': zipfile.ZIP_STORED,
+    'application/xhtml+xml': zipfile.ZIP_DEFLATED,
+    'application/oebps-package+xml': zipfile.ZIP_DEFLATED,
+    'application/x-dtbncx+xml': zipfile.ZIP_DEFLATED,
+    'application/smil+xml': zipfile.ZIP_DEFLATED,
+    'application/xml': zipfile.ZIP_DEFLATED,
+    'application/javascript': zipfile.ZIP_DEFLATED,
+    'image/svg+xml': zipfile.ZIP_DEFLATED,
+    'image/bmp': zipfile.ZIP_DEFLATED,
+    'image/tiff': zipfile.ZIP_DEFLATED,
+    'text/css': zipfile.ZIP_DEFLATED,
+    'text/html': zipfile.ZIP_DEFLATED,
+    'text/javascript': zipfile.ZIP_DEFLATED,
+    'text/plain': zipfile.ZIP_DEFLATED,
+    'text/xml': zipfile.ZIP_DEFLATED,
+    'font/ttf': zipfile.ZIP_DEFLATED,
+    'font/otf': zipfile.ZIP_DEFLATED,
+    'application/x-font-ttf': zipfile.ZIP_DEFLATED,
+    'application/vnd.ms-opentype': zipfile.ZIP_DEFLATED,
+}
+
+# Size of the sample that is compressed to decide how to store entries of unknown media types, and the
+# compressed to uncompressed ratio above which they are stored instead of deflated
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_SAMPLE_RATIO = 0.9
+
+
+def deflate(content, level=None, profile='default'):
+    """
+    Compresses content into a raw deflate stream, the way zipfile stores it.
+
+    :Args:
+      - content: bytes to compress
+      - level: zlib compression level, None for the zlib default
+      - profile: 'default' uses zlib. 'max' uses zopfli, which is much slower but gives smaller output, if it is
+        installed and zlib at level 9 otherwise.
+
+    :Returns:
+      Tuple of the compressed data, the CRC-32 and size of the content, and the seconds it took
+    """
+    start = time.time()
+
+    if profile == 'max' and zopfli is not None:
+        # Strip the 2 byte zlib header and the 4 byte Adler-32 trailer to get the raw deflate stream
+        data = zopfli.zlib.compress(content)[2:-4]
+    else:
+        if profile == 'max':
+            level = 9
+        compressor = zlib.compressobj(level if level is not None else zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        data = compressor.compress(content) + compressor.flush()
+
+    return data, zlib.crc32(content) & 0xffffffff, len(content), time.time() - start
+
+
+def deflate_file(path, level=None, profile='default'):
+    """
+    Same as deflate() but for the contents of a file, which is read in chunks. The compressed data is returned in
+    a temporary file, which is only kept in memory while it is small, instead of as bytes.
+    """
+    if profile == 'max' and zopfli is not None:
+        # zopfli needs all of the content at once
+        with open(path, 'rb') as source:
+            return deflate(source.read(), level, profile)
+
+    start = time.time()
+    compressor = zlib.compressobj(level if level is not None else zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    data = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    crc = 0
+    size = 0
+
+    with open(path, 'rb') as source:
+        chunk = source.read(FILE_CHUNK_SIZE)
+        while chunk:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            data.write(compressor.compress(chunk))
+            chunk = source.read(FILE_CHUNK_SIZE)
+
+    data.write(compressor.flush())
+
+    return data, crc & 0xffffffff, size, time.time() - start
+
+
+def get_file_digest(path):
+    """
+    Returns the sha256 hex digest of a file, read in chunks.
+    """
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as source:
+        chunk = source.read(FILE_CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = source.read(FILE_CHUNK_SIZE)
+
+    return digest.hexdigest()
+
+
 class InxEpubBook(ebooklib.epub.EpubBook):
+    """
+    Book that can store files with the same content once.
 
-    def __init__(self):
+    With deduplicate set, a file item whose content is the same as that of a file item that is already in the
+    book is not added. add_item() returns the item that is already in the book instead, and get_href() gives the
+    file name that references to the duplicate should use. Files are only hashed when there is another file of
+    the same size.
+    """
+
+    def __init__(self, deduplicate=False):
         super(InxEpubBook, self).__init__()
 
+        self.deduplicate = deduplicate
+        # file name of a duplicate -> file name of the item in the book with the same content
+        self.duplicates = {}
+        self.duplicate_bytes = 0
+        # size -> list of [item, digest], the digest is None until it is needed
+        self._file_sizes = {}
+
+    def add_item(self, item):
+        if self.deduplicate and isinstance(item, InxEpubFileItem):
+            original = self._find_duplicate(item)
+
+            if original is not None:
+                self.duplicates[item.file_name] = original.file_name
+                self.duplicate_bytes += item.size
+                return original
+
+        return super(InxEpubBook, self).add_item(item)
+
+    def _find_duplicate(self, item):
+        candidates = self._file_sizes.setdefault(item.size, [])
+        digest = None
+
+        for candidate in candidates:
+            if candidate[1] is None:
+                candidate[1] = get_file_digest(candidate[0].path)
+            if digest is None:
+                digest = get_file_digest(item.path)
+            if candidate[1] == digest:
+                return candidate[0]
+
+        candidates.append([item, digest])
+
+        return None
+
+    def get_href(self, file_name):
+        """
+        Returns the file name to reference a file by. That is the file name of the file with the same content if
+        the file was a duplicate, otherwise the file name itself.
+        """
+        return self.duplicates.get(file_name, file_name)
+
 
 class InxEpubItem(ebooklib.epub.EpubItem):
     """
@@ -56,6 +245,45 @@ class InxEpubItem(ebooklib.epub.EpubItem):
         self.create = create
 
 
+class InxEpubFileItem(InxEpubItem):
+    """
+    Item whose content is a file on disk. Only the path and stat information is kept in memory, the writer
+    copies the file into the EPUB in chunks.
+    """
+
+    def __init__(self, uid=None, file_name='', media_type='', path='', manifest=True, create=True, size=None,
+                 mtime=None):
+        super(InxEpubFileItem, self).__init__(uid=uid, file_name=file_name, media_type=media_type, content=None,
+                                              manifest=manifest, create=create)
+
+        self.path = path
+
+        # The size and modification time can be passed in if they are already known, like from a resource index
+        if size is None or mtime is None:
+            stat = os.stat(path)
+            size = stat.st_size
+            mtime = stat.st_mtime
+
+        self.size = size
+        self.mtime = mtime
+
+    def open(self):
+        """
+        Returns the file opened for reading in binary mode.
+        """
+        return open(self.path, 'rb')
+
+    def get_content(self, default=six.b('')):
+        """
+        Reads and returns the whole file. Prefer open() for large files.
+        """
+        with self.open() as handle:
+            return handle.read() or default
+
+    def __str__(self):
+        return '<InxEpubFileItem:%s:%s>' % (self.id, self.path)
+
+
 class InxEpubHtml(InxEpubItem):
 
     """
@@ -203,6 +431,13 @@ class InxEpubSvg(InxEpubHtml):
 
 
 class InxEpubWriter(ebooklib.epub.EpubWriter):
+    DEFAULT_OPTIONS = dict(ebooklib.epub.EpubWriter.DEFAULT_OPTIONS,
+                           incremental=False,
+                           compression_policy=None,
+                           compress_level=None,
+                           sample_compression=False,
+                           compress_jobs=1,
+                           compress_profile='default')
 
     def __init__(self, name, book, options=None):
         super(InxEpubWriter, self).__init__(name, book, options=None)
@@ -214,6 +449,25 @@ class InxEpubWriter(ebooklib.epub.EpubWriter):
         if options:
             self.options.update(options)
 
+        # The EPUB previously written to the same file name. Only used when the incremental option is set.
+        self.previous = None
+        self.copied_entries = 0
+        self.written_entries = 0
+
+        self.compression_policy = dict(COMPRESSION_POLICY)
+        if self.options['compression_policy']:
+            self.compression_policy.update(self.options['compression_policy'])
+
+        # media type -> dict with the number of entries, their size, their size in the EPUB and the time spent
+        # writing them. Entries copied from the previous EPUB are not included.
+        self.compression_stats = {}
+
+        # With more than one compress job, entries are deflated in a pool while this thread appends the finished
+        # entries to the EPUB in the order they were added. Each pending entry is a function that appends it.
+        self.compress_pool = None
+        self.pending_entries = collections.deque()
+        self.max_pending_entries = 0
+
     # Re-implemented this to remove ncx ref attribute from for spine
     def _write_opf_spine(self, root, ncx_id):
         # This is now an empty collection
@@ -261,17 +515,452 @@ class InxEpubWriter(ebooklib.epub.EpubWriter):
 
             etree.SubElement(spine, 'itemref', opts)
 
+    def _write_container(self):
+        container_xml = ebooklib.epub.CONTAINER_XML % {'folder_name': self.book.FOLDER_NAME}
+        self._write_entry(ebooklib.epub.CONTAINER_PATH, container_xml, 'application/xml')
+
+    def _write_opf_file(self, root):
+        tree_str = etree.tostring(root, pretty_print=True, encoding='utf-8', xml_declaration=True)
+
+        self._write_entry('%s/content.opf' % self.book.FOLDER_NAME, tree_str, 'application/oebps-package+xml')
+
     def _write_items(self):
         for item in self.book.get_items():
-            if not hasattr(item, 'create') or item.create:
-                if isinstance(item, ebooklib.epub.EpubNcx):
-                    self.out.writestr('%s/%s' % (self.book.FOLDER_NAME, item.file_name), self._get_ncx())
-                elif isinstance(item, ebooklib.epub.EpubNav):
-                    self.out.writestr('%s/%s' % (self.book.FOLDER_NAME, item.file_name), self._get_nav(item))
-                elif item.manifest:
-                    self.out.writestr('%s/%s' % (self.book.FOLDER_NAME, item.file_name), item.get_content())
+            self._write_item(item)
+
+    def _write_item(self, item):
+        if not hasattr(item, 'create') or item.create:
+            if isinstance(item, ebooklib.epub.EpubNcx):
+                self._write_entry('%s/%s' % (self.book.FOLDER_NAME, item.file_name), self._get_ncx(),
+                                  item.media_type)
+            elif isinstance(item, ebooklib.epub.EpubNav):
+                self._write_entry('%s/%s' % (self.book.FOLDER_NAME, item.file_name), self._get_nav(item),
+                                  item.media_type)
+            elif isinstance(item, InxEpubFileItem):
+                if item.manifest:
+                    self._write_file_entry('%s/%s' % (self.book.FOLDER_NAME, item.file_name), item)
                 else:
-                    self.out.writestr('%s' % item.file_name, item.get_content())
+                    self._write_file_entry('%s' % item.file_name, item)
+            elif item.manifest:
+                self._write_entry('%s/%s' % (self.book.FOLDER_NAME, item.file_name), item.get_content(),
+                                  item.media_type)
+            else:
+                self._write_entry('%s' % item.file_name, item.get_content(), item.media_type)
+
+    def _get_compress_type(self, media_type, sample):
+        """
+        Returns the compression to use for an entry of the given media type. The sample is the start of the
+        content and is only used for media types that are not in the compression policy.
+        """
+        compress_type = self.compression_policy.get(media_type)
+
+        if compress_type is not None:
+            return compress_type
+
+        if self.options['sample_compression'] and len(sample) > 0:
+            level = self.options['compress_level']
+            compressed = zlib.compress(sample, level if level is not None else -1)
+
+            if len(compressed) > len(sample) * COMPRESSION_SAMPLE_RATIO:
+                return zipfile.ZIP_STORED
+
+        return zipfile.ZIP_DEFLATED
+
+    def _add_compression_stats(self, media_type, size, compressed_size, seconds, compress_type):
+        stats = self.compression_stats.setdefault(media_type or 'application/octet-stream', {
+            'entries': 0, 'size': 0, 'compressed_size': 0, 'seconds': 0.0, 'compress_type': None
+        })
+
+        stats['entries'] += 1
+        stats['size'] += size
+        stats['compressed_size'] += compressed_size
+        stats['seconds'] += seconds
+        stats['compress_type'] = compress_type
+
+    def _start_compress_pool(self):
+        jobs = self.options['compress_jobs']
+
+        if jobs <= 0:
+            jobs = inx_pipeline.available_cpus()
+
+        if jobs <= 1:
+            return
+
+        # zlib releases the GIL while it compresses so threads are enough, zopfli does not
+        if self.options['compress_profile'] == 'max' and zopfli is not None:
+            self.compress_pool = ProcessPoolExecutor(max_workers=jobs)
+        else:
+            self.compress_pool = ThreadPoolExecutor(max_workers=jobs)
+
+        self.max_pending_entries = jobs * 2
+
+    def _stop_compress_pool(self):
+        if self.compress_pool is not None:
+            # Entries that are still queued are not compressed after a failed write. shutdown() can only cancel
+            # them itself from Python 3.9.
+            for append in self.pending_entries:
+                for arg in append.args:
+                    if isinstance(arg, Future):
+                        arg.cancel()
+
+            self.compress_pool.shutdown(wait=True)
+            self.compress_pool = None
+
+    def _use_deflate(self):
+        # zipfile compresses with zlib at the configured level, other profiles and parallel compression need deflate()
+        return self.compress_pool is not None or self.options['compress_profile'] != 'default'
+
+    def _submit(self, function, *args):
+        """
+        Runs function in the compress pool, or right away if there is no pool, and returns a Future for the result.
+        """
+        if self.compress_pool is not None:
+            return self.compress_pool.submit(function, *args)
+
+        future = Future()
+        future.set_result(function(*args))
+        return future
+
+    def _queue_entry(self, append):
+        """
+        Appends an entry to the EPUB by calling append(). When entries are compressed in parallel the call is
+        queued instead, so that entries end up in the order they were added while a bounded number of them are
+        being compressed.
+        """
+        if self.compress_pool is None:
+            append()
+            return
+
+        self.pending_entries.append(append)
+
+        while len(self.pending_entries) > self.max_pending_entries:
+            self.pending_entries.popleft()()
+
+    def _flush_entries(self):
+        while len(self.pending_entries) > 0:
+            self.pending_entries.popleft()()
+
+    def _append_deflated_entry(self, name, media_type, future):
+        data, crc, size, seconds = future.result()
+
+        zinfo = self._write_raw_entry(name, data, crc, size, zipfile.ZIP_DEFLATED, time.localtime(time.time())[:6])
+        self._add_compression_stats(media_type, size, zinfo.compress_size, seconds, zipfile.ZIP_DEFLATED)
+
+    def _append_entry(self, name, content, media_type, compress_type):
+        start = time.time()
+        self.out.writestr(name, content, compress_type=compress_type)
+
+        self._add_compression_stats(media_type, len(content), self.out.filelist[-1].compress_size,
+                                    time.time() - start, compress_type)
+
+    def _append_file_entry(self, name, item, compress_type):
+        zinfo = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+        zinfo.compress_type = compress_type
+        zinfo.file_size = item.size
+        zinfo.external_attr = 0o600 << 16
+        zinfo._compresslevel = self.options['compress_level']
+
+        start = time.time()
+
+        with item.open() as source:
+            with self.out.open(zinfo, 'w') as target:
+                shutil.copyfileobj(source, target, FILE_CHUNK_SIZE)
+
+        self._add_compression_stats(item.media_type, item.size, zinfo.compress_size, time.time() - start,
+                                    compress_type)
+
+    def get_compression_report(self):
+        """
+        Returns a list of lines describing the bytes and time saved per media type. The time saved on stored
+        entries is estimated from the deflate throughput of this write.
+        """
+        deflated_size = 0
+        deflated_seconds = 0.0
+
+        for stats in self.compression_stats.values():
+            if stats['compress_type'] == zipfile.ZIP_DEFLATED:
+                deflated_size += stats['size']
+                deflated_seconds += stats['seconds']
+
+        lines = []
+
+        for media_type in sorted(self.compression_stats):
+            stats = self.compression_stats[media_type]
+
+            if stats['compress_type'] == zipfile.ZIP_STORED:
+                seconds_saved = stats['size'] * deflated_seconds / deflated_size if deflated_size > 0 else 0.0
+                lines.append('%s: %d stored, %d bytes, about %.2fs of compression saved'
+                             % (media_type, stats['entries'], stats['size'], seconds_saved))
+            else:
+                lines.append('%s: %d deflated, %d bytes saved in %.2fs'
+                             % (media_type, stats['entries'], stats['size'] - stats['compressed_size'],
+                                stats['seconds']))
+
+        return lines
+
+    def _write_entry(self, name, content, media_type=None, compress_type=None):
+        """
+        Writes an entry to the EPUB. In incremental mode entries that are unchanged since the previous
+        EPUB are copied over as they are, without being decompressed and compressed again.
+
+        An entry counts as unchanged when its compression method, size and CRC-32 are the same as in the previous
+        EPUB. These are read from the zip directory, so no digest has to be stored or the previous entry read.
+        CRC-32 is not a cryptographic hash, an edit that keeps both the size and the CRC-32 would go unnoticed.
+        """
+        if isinstance(content, six.text_type):
+            content = content.encode('utf-8')
+
+        if compress_type is None:
+            compress_type = self._get_compress_type(media_type, content[:COMPRESSION_SAMPLE_SIZE])
+
+        if self.previous is not None:
+            info = self.previous.NameToInfo.get(name)
+
+            # CRC-32 and size are stored in the zip so the previous entry does not have to be read to compare them
+            if info is not None and info.compress_type == compress_type and info.file_size == len(content) \
+                    and info.CRC == (zlib.crc32(content) & 0xffffffff):
+                self._queue_entry(functools.partial(self._copy_raw_entry, info))
+                return
+
+        if compress_type == zipfile.ZIP_DEFLATED and self._use_deflate():
+            future = self._submit(deflate, content, self.options['compress_level'], self.options['compress_profile'])
+            self._queue_entry(functools.partial(self._append_deflated_entry, name, media_type, future))
+        else:
+            self._queue_entry(functools.partial(self._append_entry, name, content, media_type, compress_type))
+
+    def _write_file_entry(self, name, item):
+        """
+        Writes a file backed item to the EPUB, streaming it from disk in chunks. Unchanged files are compared
+        the same way as in _write_entry().
+        """
+        sample = six.b('')
+        if item.media_type not in self.compression_policy and self.options['sample_compression']:
+            with item.open() as source:
+                sample = source.read(COMPRESSION_SAMPLE_SIZE)
+
+        compress_type = self._get_compress_type(item.media_type, sample)
+
+        if self.previous is not None:
+            info = self.previous.NameToInfo.get(name)
+
+            if info is not None and info.compress_type == compress_type and info.file_size == item.size \
+                    and info.CRC == self._get_file_crc(item):
+                self._queue_entry(functools.partial(self._copy_raw_entry, info))
+                return
+
+        if compress_type == zipfile.ZIP_DEFLATED and self._use_deflate():
+            future = self._submit(deflate_file, item.path, self.options['compress_level'],
+                                  self.options['compress_profile'])
+            self._queue_entry(functools.partial(self._append_deflated_entry, name, item.media_type, future))
+        else:
+            self._queue_entry(functools.partial(self._append_file_entry, name, item, compress_type))
+
+    def _get_file_crc(self, item):
+        crc = 0
+
+        with item.open() as source:
+            chunk = source.read(FILE_CHUNK_SIZE)
+            while chunk:
+                crc = zlib.crc32(chunk, crc)
+                chunk = source.read(FILE_CHUNK_SIZE)
+
+        return crc & 0xffffffff
+
+    def _copy_raw_entry(self, info):
+        # Read the compressed data straight from the previous file. The data starts after the local file header,
+        # whose file name and extra field lengths may differ from the ones in the central directory.
+        source = self.previous.fp
+        source.seek(info.header_offset)
+        header = source.read(zipfile.sizeFileHeader)
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        source.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+
+        self._write_raw_entry(info.filename, source.read(info.compress_size), info.CRC, info.file_size,
+                              info.compress_type, info.date_time)
+
+        self.copied_entries += 1
+
+    def _write_raw_entry(self, name, data, crc, file_size, compress_type, date_time):
+        """
+        Appends an entry with already compressed data to the EPUB. The data is bytes, or a file that is copied
+        in chunks and closed.
+
+        :Returns:
+          The ZipInfo of the entry
+        """
+        zinfo = zipfile.ZipInfo(name, date_time)
+        zinfo.compress_type = compress_type
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        zinfo.external_attr = 0o600 << 16
+
+        if isinstance(data, bytes):
+            zinfo.compress_size = len(data)
+        else:
+            zinfo.compress_size = data.tell()
+            data.seek(0)
+
+        out = self.out
+        zinfo.header_offset = out.fp.tell()
+        out.fp.write(zinfo.FileHeader())
+
+        if isinstance(data, bytes):
+            out.fp.write(data)
+        else:
+            with data:
+                shutil.copyfileobj(data, out.fp, FILE_CHUNK_SIZE)
+
+        out.start_dir = out.fp.tell()
+        out.filelist.append(zinfo)
+        out.NameToInfo[zinfo.filename] = zinfo
+        out._didModify = True
+
+        return zinfo
+
+    def open(self):
+        """
+        Opens the output file and writes the entries that come first in every EPUB.
+        """
+        self.previous = None
+        self.temp_name = None
+
+        if self.options['incremental'] and os.path.isfile(self.file_name):
+            try:
+                self.previous = zipfile.ZipFile(self.file_name, 'r')
+            except zipfile.BadZipfile:
+                self.previous = None
+
+        if self.previous is not None:
+            # The previous EPUB is read while the new one is written, so the new one goes to a temporary file
+            # which replaces the previous one when it is complete.
+            handle, self.temp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.file_name)),
+                                                      suffix='.epub')
+            os.close(handle)
+            # mkstemp creates the file readable by the owner only, the EPUB keeps the permissions it had
+            shutil.copymode(self.file_name, self.temp_name)
+            self.out = zipfile.ZipFile(self.temp_name, 'w', zipfile.ZIP_DEFLATED,
+                                       compresslevel=self.options['compress_level'])
+        else:
+            self.out = zipfile.ZipFile(self.file_name, 'w', zipfile.ZIP_DEFLATED,
+                                       compresslevel=self.options['compress_level'])
+
+        self._start_compress_pool()
+
+        # The mimetype entry must always be first, and stored
+        self._write_entry('mimetype', 'application/epub+zip', 'application/epub+zip', zipfile.ZIP_STORED)
+        self._write_container()
+
+    def close(self):
+        """
+        Finishes the output file.
+        """
+        try:
+            self._flush_entries()
+        finally:
+            self._stop_compress_pool()
+
+        self.out.close()
+
+        if self.previous is not None:
+            self.previous.close()
+            self.previous = None
+            os.replace(self.temp_name, self.file_name)
+
+        self.written_entries = len(self.out.filelist) - self.copied_entries
+
+    def discard(self):
+        """
+        Closes the output file after a failed write. A temporary file is removed, leaving the previous EPUB as it was.
+        """
+        self._stop_compress_pool()
+        self.pending_entries.clear()
+        self.out.close()
+
+        if self.previous is not None:
+            self.previous.close()
+            self.previous = None
+            os.remove(self.temp_name)
+
+    def write(self):
+        self.open()
+
+        try:
+            self._write_opf()
+            self._write_items()
+            self._flush_entries()
+        except:
+            self.discard()
+            raise
+
+        self.close()
+
+
+class InxEpubStreamWriter(InxEpubWriter):
+    """
+    Writes documents to the EPUB as soon as they are added, instead of keeping the whole book in memory until
+    it is written. Only the manifest and spine information of a document is kept after it has been written. The
+    OPF, the nav and any item that has not been written yet are written by close().
+
+    >>> epub = InxEpubStreamWriter('book.epub', book)
+    >>> epub.open()
+    >>> epub.add_document(doc)
+    >>> epub.close()
+    """
+
+    def __init__(self, name, book, options=None):
+        super(InxEpubStreamWriter, self).__init__(name, book, options)
+
+        self.written_items = set()
+        self.closing = False
+
+    def open(self):
+        super(InxEpubStreamWriter, self).open()
+
+        # Items added to the book before the EPUB was opened, like resources and scripts
+        self._write_items()
+
+    def add_document(self, item, spine=True):
+        """
+        Adds a document to the book, writes it to the EPUB and releases its content.
+
+        :Args:
+          - item: Item instance
+          - spine: Add the document to the spine? Default value is True.
+        """
+        self.book.add_item(item)
+
+        if spine:
+            self.book.spine.append(item)
+
+        self._write_item(item)
+
+    def _write_item(self, item):
+        if item in self.written_items:
+            return
+
+        # Navigation documents are generated from the complete book, so they are written last
+        if isinstance(item, (ebooklib.epub.EpubNcx, ebooklib.epub.EpubNav)) and not self.closing:
+            return
+
+        super(InxEpubStreamWriter, self)._write_item(item)
+
+        self.written_items.add(item)
+
+        if not isinstance(item, (ebooklib.epub.EpubNcx, ebooklib.epub.EpubNav)):
+            item.content = six.b('')
+
+    def close(self):
+        self.closing = True
+
+        try:
+            self._write_items()
+            self._write_opf()
+            self._flush_entries()
+        except:
+            self.discard()
+            raise
+
+        super(InxEpubStreamWriter, self).close()
 
 
 def write_epub(name, book, options=None):
@@ -284,6 +973,9 @@ def write_epub(name, book, options=None):
       - name: file name for the output file
       - book: instance of EpubBook
       - options: extra opions as dictionary (optional)
+
+    :Returns:
+      The InxEpubWriter instance used to write the file.
     """
     epub = InxEpubWriter(name, book, options)
 
@@ -293,3 +985,5 @@ def write_epub(name, book, options=None):
         epub.write()
     except IOError:
         pass
+
+    return epub
@@ -0,0 +1,524 @@
+"""
+    MIT License
+
+    Copyright (c) 2020 Lars C Wallin <larscwallin@gmail.com>
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import io
+import json
+import os
+import re
+import struct
+import tempfile
+import zlib
+
+try:
+    # Optional, needed to read WOFF2 fonts
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    # Optional, needed to subset fonts
+    import fontTools
+    from fontTools import subset as font_subset
+    from fontTools.ttLib import TTFont
+except ImportError:
+    fontTools = None
+    font_subset = None
+    TTFont = None
+
+# Tags of the tables in a WOFF2 font, by their index in the table directory
+WOFF2_KNOWN_TAGS = (
+    'cmap', 'head', 'hhea', 'hmtx', 'maxp', 'name', 'OS/2', 'post', 'cvt ', 'fpgm', 'glyf', 'loca', 'prep', 'CFF ',
+    'VORG', 'EBDT', 'EBLC', 'gasp', 'hdmx', 'kern', 'LTSH', 'PCLT', 'VDMX', 'vhea', 'vmtx', 'BASE', 'GDEF', 'GPOS',
+    'GSUB', 'EBSC', 'JSTF', 'MATH', 'CBDT', 'CBLC', 'COLR', 'CPAL', 'SVG ', 'sbix', 'acnt', 'avar', 'bdat', 'bloc',
+    'bsln', 'cvar', 'fdsc', 'feat', 'fmtx', 'fvar', 'gvar', 'hsty', 'just', 'lcar', 'mort', 'morx', 'opbd', 'prop',
+    'trak', 'Zapf', 'Silf', 'Glat', 'Gloc', 'Feat', 'Sill'
+)
+
+# Matches the font-family declaration of a style attribute
+FONT_FAMILY_DECLARATION = re.compile(r'(^|;)(\s*font-family\s*:\s*)([^;]*)')
+# The same in the rules of a style sheet, without the whitespace before the end of the declaration
+FONT_FAMILY_RULE = re.compile(r'([{;])(\s*font-family\s*:\s*)([^;}]*?)(?=\s*[;}])')
+
+# Fonts that can be converted to WOFF2
+WOFF2_SOURCE_EXTENSIONS = ('.ttf', '.otf')
+
+FONT_WEIGHTS = {'normal': 400, 'bold': 700, 'lighter': 300, 'bolder': 700}
+
+# Subfamily names that give away the weight of fonts without an OS/2 table
+SUBFAMILY_WEIGHTS = (
+    ('thin', 100), ('hairline', 100), ('extralight', 200), ('ultralight', 200), ('light', 300), ('medium', 500),
+    ('semibold', 600), ('demibold', 600), ('extrabold', 800), ('ultrabold', 800), ('black', 900), ('heavy', 900),
+    ('bold', 700)
+)
+
+
+def read_tables(handle, tags):
+    """
+    Returns a dict with the raw data of the tables with the given tags, read from a TTF, OTF, TTC, WOFF or WOFF2
+    font. Tables that are missing are left out. Returns None if the file is not a font that can be read.
+    """
+    signature = handle.read(4)
+
+    if signature == b'ttcf':
+        # Collections hold several fonts, the first one is used
+        handle.seek(12)
+        offset = struct.unpack('>I', handle.read(4))[0]
+        handle.seek(offset)
+        signature = handle.read(4)
+
+    if signature in (b'\x00\x01\x00\x00', b'OTTO', b'true'):
+        offset = handle.tell() - 4
+        handle.seek(offset + 4)
+        count = struct.unpack('>H', handle.read(2))[0]
+        handle.seek(offset + 12)
+
+        records = [struct.unpack('>4sIII', handle.read(16)) for index in range(count)]
+        tables = {}
+
+        for tag, checksum, table_offset, length in records:
+            tag = tag.decode('latin-1')
+            if tag in tags:
+                handle.seek(table_offset)
+                tables[tag] = handle.read(length)
+
+        return tables
+
+    if signature == b'wOFF':
+        handle.seek(12)
+        count = struct.unpack('>H', handle.read(2))[0]
+        handle.seek(44)
+
+        records = [struct.unpack('>4sIIII', handle.read(20)) for index in range(count)]
+        tables = {}
+
+        for tag, table_offset, compressed_length, length, checksum in records:
+            tag = tag.decode('latin-1')
+            if tag in tags:
+                handle.seek(table_offset)
+                data = handle.read(compressed_length)
+                tables[tag] = zlib.decompress(data) if compressed_length < length else data
+
+        return tables
+
+    if signature == b'wOF2':
+        return _read_woff2_tables(handle, tags)
+
+    return None
+
+
+def _read_base128(handle):
+    value = 0
+
+    for index in range(5):
+        byte = handle.read(1)[0]
+        value = (value << 7) | (byte & 0x7f)
+
+        if not byte & 0x80:
+            return value
+
+    raise ValueError('Invalid UIntBase128 value')
+
+
+def _read_woff2_tables(handle, tags):
+    if brotli is None:
+        return None
+
+    flavor = handle.read(4)
+    handle.seek(12)
+    count = struct.unpack('>H', handle.read(2))[0]
+    handle.seek(20)
+    compressed_size = struct.unpack('>I', handle.read(4))[0]
+
+    # Collections are not supported
+    if flavor == b'ttcf':
+        return None
+
+    handle.seek(48)
+    directory = []
+
+    for index in range(count):
+        flags = handle.read(1)[0]
+        tag_index = flags & 0x3f
+        tag = handle.read(4).decode('latin-1') if tag_index == 63 else WOFF2_KNOWN_TAGS[tag_index]
+        length = _read_base128(handle)
+        version = flags >> 6
+
+        # glyf and loca are transformed unless the version is 3, other tables are transformed unless it is 0
+        transformed = version != 3 if tag in ('glyf', 'loca') else version != 0
+        if transformed:
+            length = _read_base128(handle)
+
+        directory.append((tag, length))
+
+    data = brotli.decompress(handle.read(compressed_size))
+    tables = {}
+    offset = 0
+
+    for tag, length in directory:
+        if tag in tags:
+            tables[tag] = data[offset:offset + length]
+        offset += length
+
+    return tables
+
+
+def parse_name_table(data):
+    """
+    Returns a dict of name id -> string from a name table. English Windows names are preferred.
+    """
+    format_, count, string_offset = struct.unpack('>HHH', data[:6])
+    names = {}
+    ranks = {}
+
+    for index in range(count):
+        platform, encoding, language, name_id, length, offset = struct.unpack(
+            '>HHHHHH', data[6 + index * 12:18 + index * 12])
+        raw = data[string_offset + offset:string_offset + offset + length]
+
+        if platform == 3 and encoding in (0, 1, 10):
+            rank = 0 if language == 0x409 else 1
+            codec = 'utf-16-be'
+        elif platform == 0:
+            rank = 2
+            codec = 'utf-16-be'
+        elif platform == 1 and encoding == 0:
+            rank = 3 if language == 0 else 4
+            codec = 'mac-roman'
+        else:
+            continue
+
+        if name_id not in ranks or rank < ranks[name_id]:
+            try:
+                names[name_id] = raw.decode(codec).strip()
+                ranks[name_id] = rank
+            except UnicodeDecodeError:
+                pass
+
+    return names
+
+
+def read_font_info(path):
+    """
+    Returns a dict with the 'family', 'subfamily', 'full_name', 'weight' (100-900) and 'italic' of a font file,
+    or None if it can not be read.
+    """
+    try:
+        with io.open(path, 'rb') as handle:
+            tables = read_tables(handle, ('name', 'OS/2'))
+    except (IOError, OSError, ValueError, IndexError, struct.error, zlib.error):
+        return None
+
+    if not tables or 'name' not in tables:
+        return None
+
+    try:
+        names = parse_name_table(tables['name'])
+    except struct.error:
+        return None
+
+    # The typographic family groups all weights of a family, the legacy family only four of them
+    family = names.get(16) or names.get(1)
+    subfamily = names.get(17) or names.get(2) or 'Regular'
+
+    if not family:
+        return None
+
+    weight = None
+    italic = None
+
+    if 'OS/2' in tables and len(tables['OS/2']) >= 64:
+        weight = struct.unpack('>H', tables['OS/2'][4:6])[0]
+        selection = struct.unpack('>H', tables['OS/2'][62:64])[0]
+        italic = bool(selection & 0x201)
+
+    simple_subfamily = subfamily.lower().replace(' ', '').replace('-', '')
+
+    if not weight or weight > 1000:
+        weight = 400
+        for name, value in SUBFAMILY_WEIGHTS:
+            if name in simple_subfamily:
+                weight = value
+                break
+
+    if italic is None:
+        italic = 'italic' in simple_subfamily or 'oblique' in simple_subfamily
+
+    return {
+        'family': family,
+        'subfamily': subfamily,
+        'full_name': names.get(4, ''),
+        'weight': weight,
+        'italic': italic
+    }
+
+
+def parse_font_family(value):
+    """
+    Returns the list of family names in a CSS font-family value, without quotes.
+    """
+    families = []
+
+    for family in (value or '').split(','):
+        family = family.strip().strip('\'"').strip()
+        if family:
+            families.append(family)
+
+    return families
+
+
+def parse_font_weight(value):
+    value = str(value or 'normal').strip().lower()
+
+    if value in FONT_WEIGHTS:
+        return FONT_WEIGHTS[value]
+
+    try:
+        return int(float(value))
+    except ValueError:
+        return 400
+
+
+def get_weight_rank(desired, weight):
+    """
+    Returns a sort key for how well a weight matches the desired weight, following the CSS font matching rules.
+    """
+    if weight == desired:
+        return 0, 0
+
+    if 400 <= desired <= 500:
+        if desired < weight <= 500:
+            return 1, weight - desired
+        if weight < desired:
+            return 2, desired - weight
+        return 3, weight - desired
+
+    if desired < 400:
+        if weight < desired:
+            return 1, desired - weight
+        return 2, weight - desired
+
+    if weight > desired:
+        return 1, weight - desired
+    return 2, desired - weight
+
+
+class FontCatalog(object):
+    """
+    Catalog of the fonts in the resources folder, with the family, subfamily, weight and style read from the name
+    and OS/2 tables of each font.
+
+    The catalog is stored as JSON so that fonts are only read again when they have been changed, which is found
+    out from the size and modification time of the files.
+    """
+
+    # Bump this whenever the information stored for each font changes
+    VERSION = 1
+
+    def __init__(self, path=None):
+        """
+        :Args:
+          - path: optional file that the catalog is loaded from and saved to
+        """
+        self.path = path
+        self.fonts = {}
+        # lower case family name -> list of font dicts
+        self.families = {}
+        self.parsed = 0
+        self.changed = False
+
+        if self.path is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with io.open(self.path, 'r', encoding='utf-8') as handle:
+                catalog = json.load(handle)
+        except (IOError, OSError, ValueError):
+            return
+
+        if catalog.get('version') == self.VERSION:
+            self.fonts = catalog.get('fonts', {})
+
+    def save(self):
+        """
+        Saves the catalog if it has changed. Errors are ignored, the catalog is only there to save time.
+        """
+        if self.path is None or not self.changed:
+            return
+
+        folder = os.path.dirname(self.path)
+
+        try:
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+
+            handle, temp_path = tempfile.mkstemp(dir=folder or None, prefix='.tmp-')
+
+            with os.fdopen(handle, 'w') as temp_file:
+                json.dump({'version': self.VERSION, 'fonts': self.fonts}, temp_file)
+
+            os.replace(temp_path, self.path)
+            self.changed = False
+        except (IOError, OSError):
+            pass
+
+    def update(self, files):
+        """
+        Reads the fonts that are new or have changed and forgets the ones that are gone.
+
+        :Args:
+          - files: iterable of (path, size, mtime) tuples, like the font entries of a ResourceIndex
+        """
+        fonts = {}
+
+        for path, size, mtime in files:
+            font = self.fonts.get(path)
+
+            if font is None or font.get('size') != size or font.get('mtime') != mtime:
+                font = read_font_info(path) or {}
+                font.update({'path': path, 'size': size, 'mtime': mtime})
+                self.parsed += 1
+                self.changed = True
+
+            fonts[path] = font
+
+        if len(fonts) != len(self.fonts):
+            self.changed = True
+
+        self.fonts = fonts
+        self.families = {}
+
+        for path in sorted(self.fonts):
+            font = self.fonts[path]
+            if font.get('family'):
+                self.families.setdefault(font['family'].lower(), []).append(font)
+
+    def find(self, font_family, font_weight='normal', font_style='normal'):
+        """
+        Returns the font dict that best matches a CSS font-family, font-weight and font-style, or None.
+        """
+        desired_weight = parse_font_weight(font_weight)
+        desired_italic = str(font_style or 'normal').strip().lower() in ('italic', 'oblique')
+
+        for family in parse_font_family(font_family):
+            fonts = self.families.get(family.lower())
+
+            if fonts:
+                return min(fonts, key=lambda font: (font['italic'] != desired_italic,
+                                                    get_weight_rank(desired_weight, font['weight']),
+                                                    font['path']))
+
+        return None
+
+
+def get_catalog_path(cache_folder=''):
+    """
+    Returns where the font catalog is stored: in the cache folder if one is given. Without a cache folder the
+    catalog is only kept in memory, and None is returned.
+    """
+    if cache_folder:
+        return os.path.join(os.path.expanduser(cache_folder), 'font-catalog.json')
+
+    return None
+
+
+def get_font_face_descriptors(font):
+    """
+    Returns the font-weight and font-style descriptors of an @font-face rule for a font in the catalog.
+    """
+    return '\n      font-weight: %d;\n      font-style: %s;' % (font['weight'], 'italic' if font['italic'] else 'normal')
+
+
+def rename_font_families(elements, names, styles=()):
+    """
+    Renames the font families set by the style and font-family attributes of elements, and by the rules of style
+    elements.
+
+    :Args:
+      - elements: elements to rename the font families of, like DocumentIndex.font_elements
+      - names: dict of font-family value -> new value
+      - styles: style elements to rename the font families in, like DocumentIndex.styles
+    """
+    def rename(match):
+        value = match.group(3).strip()
+        return match.group(1) + match.group(2) + names.get(value, value)
+
+    for style in styles:
+        if style.text and 'font-family' in style.text:
+            style.text = FONT_FAMILY_RULE.sub(rename, style.text)
+
+    for element in elements:
+        style = element.get('style')
+        if style and 'font-family' in style:
+            element.set('style', FONT_FAMILY_DECLARATION.sub(rename, style))
+
+        font_family = element.get('font-family')
+        if font_family is not None and font_family in names:
+            element.set('font-family', names[font_family])
+
+
+def subset_font(content, text):
+    """
+    Returns a copy of a font with only the glyphs needed to show text, in the same format as the font. Needs
+    fontTools.
+
+    :Args:
+      - content: the font file as bytes
+      - text: the characters to keep
+    """
+    options = font_subset.Options()
+    font = font_subset.load_font(io.BytesIO(content), options)
+    # Save the subset in the same format as the font, so that its file name and media type stay right
+    options.flavor = font.flavor
+
+    subsetter = font_subset.Subsetter(options)
+    subsetter.populate(text=text)
+    subsetter.subset(font)
+
+    output = io.BytesIO()
+    font_subset.save_font(font, output, options)
+    font.close()
+
+    return output.getvalue()
+
+
+def can_convert_to_woff2():
+    return TTFont is not None and brotli is not None
+
+
+def convert_to_woff2(content):
+    """
+    Returns a TTF or OTF font converted to WOFF2. Needs fontTools and brotli.
+
+    :Args:
+      - content: the font file as bytes
+    """
+    font = TTFont(io.BytesIO(content))
+    font.flavor = 'woff2'
+
+    output = io.BytesIO()
+    font.save(output)
+    font.close()
+
+    return output.getvalue()
@@ -0,0 +1,154 @@
+"""
+    MIT License
+
+    Copyright (c) 2020 Lars C Wallin <larscwallin@gmail.com>
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import base64
+import io
+import math
+import mimetypes
+import urllib.parse
+
+try:
+    # Optional, needed to optimize images
+    import PIL
+    from PIL import Image
+except ImportError:
+    PIL = None
+    Image = None
+
+# Image format -> (mime type, file extension)
+IMAGE_FORMATS = {
+    'jpeg': ('image/jpeg', '.jpg'),
+    'png': ('image/png', '.png'),
+    'webp': ('image/webp', '.webp')
+}
+
+
+def decode_data_uri(uri):
+    """
+    Returns a (mime type, content as bytes) tuple for a data: URI, or None if it is not a valid data: URI.
+    """
+    header, separator, data = uri.partition(',')
+
+    if not separator or header[:5].lower() != 'data:':
+        return None
+
+    parameters = header[5:].split(';')
+    mime_type = parameters[0].strip().lower() or 'text/plain'
+
+    try:
+        if 'base64' in (parameter.strip().lower() for parameter in parameters[1:]):
+            # Line breaks and other characters outside of the base64 alphabet are skipped
+            content = base64.b64decode(data)
+        else:
+            content = urllib.parse.unquote_to_bytes(data)
+    except ValueError:
+        return None
+
+    return mime_type, content
+
+
+def get_extension(mime_type):
+    """
+    Returns the file extension for an image mime type, like '.png'.
+    """
+    for image_format, (format_mime_type, extension) in IMAGE_FORMATS.items():
+        if format_mime_type == mime_type:
+            return extension
+
+    return mimetypes.guess_extension(mime_type) or '.bin'
+
+
+def get_image_format(content):
+    """
+    Returns the format of a JPEG, PNG or WebP image, or None.
+    """
+    if content[:2] == b'\xff\xd8':
+        return 'jpeg'
+    if content[:4] == b'\x89PNG':
+        return 'png'
+    if content[:4] == b'RIFF' and content[8:12] == b'WEBP':
+        return 'webp'
+
+    return None
+
+
+def get_image_settings(image_format='auto', quality=85):
+    """
+    Returns the settings for optimize_image().
+
+    :Args:
+      - image_format: 'jpeg', 'png' or 'webp' to save all images in that format, or 'auto' to keep JPEG images
+        JPEG and save all other images as PNG. Images with transparency are never saved as JPEG.
+      - quality: JPEG and WebP quality, 1-100
+    """
+    return {'format': image_format, 'quality': quality}
+
+
+def optimize_image(content, size, settings):
+    """
+    Scales an image down to a size and saves it in the format given by the settings. Runs in worker processes.
+
+    :Args:
+      - content: the image file as bytes
+      - size: (width, height) in pixels that the image is shown at. The image keeps its aspect ratio and covers
+        the size, it is never scaled up.
+      - settings: dict from get_image_settings()
+
+    :Returns:
+      The optimized image as bytes, or None if the image can not be optimized
+    """
+    image = Image.open(io.BytesIO(content))
+
+    # Animations would lose all but their first frame
+    if getattr(image, 'is_animated', False):
+        return None
+
+    image.load()
+    source_format = (image.format or '').lower()
+    scale = max(float(size[0]) / image.width, float(size[1]) / image.height)
+
+    if scale < 1:
+        image = image.resize((max(1, int(math.ceil(image.width * scale))),
+                              max(1, int(math.ceil(image.height * scale)))), Image.LANCZOS)
+
+    transparent = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+
+    image_format = settings['format']
+    if image_format == 'auto':
+        image_format = 'jpeg' if source_format == 'jpeg' else 'png'
+    if image_format == 'jpeg' and transparent:
+        image_format = 'png'
+
+    output = io.BytesIO()
+
+    if image_format == 'jpeg':
+        if image.mode not in ('RGB', 'L', 'CMYK'):
+            image = image.convert('RGB')
+        image.save(output, 'JPEG', quality=settings['quality'], optimize=True, progressive=True)
+    elif image_format == 'webp':
+        image.save(output, 'WEBP', quality=settings['quality'], method=6)
+    else:
+        image.save(output, 'PNG', optimize=True)
+
+    return output.getvalue()
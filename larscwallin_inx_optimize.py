@@ -0,0 +1,324 @@
+"""
+    MIT License
+
+    Copyright (c) 2020 Lars C Wallin <larscwallin@gmail.com>
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import math
+import re
+
+from lxml import etree
+
+from larscwallin_inx_analysis import parse_style
+
+SVG_NAMESPACE = 'http://www.w3.org/2000/svg'
+INKSCAPE_NAMESPACE = 'http://www.inkscape.org/namespaces/inkscape'
+SODIPODI_NAMESPACE = 'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd'
+
+# Elements and attributes in these namespaces are only used by Inkscape
+EDITOR_NAMESPACES = (INKSCAPE_NAMESPACE, SODIPODI_NAMESPACE)
+
+# Whitespace in these elements is content and is left alone
+TEXT_CONTENT_TAGS = set('{%s}%s' % (SVG_NAMESPACE, name) for name in (
+    'text', 'tspan', 'textPath', 'flowRoot', 'flowPara', 'flowSpan', 'flowDiv', 'title', 'desc', 'style', 'script'
+))
+
+# Animations can show content that is hidden to begin with
+ANIMATION_TAGS = set('{%s}%s' % (SVG_NAMESPACE, name) for name in (
+    'animate', 'animateColor', 'animateMotion', 'animateTransform', 'set'
+))
+
+# Labels of sublayers that hold guides and other drawing aids
+GUIDE_LAYER_LABELS = set(('guide', 'guides'))
+
+CONTAINER_TAGS = set('{%s}%s' % (SVG_NAMESPACE, name) for name in ('g', 'defs'))
+
+# Attributes with coordinates and lengths. Their numbers are rounded to a number of significant digits.
+GEOMETRY_ATTRIBUTES = set((
+    'd', 'points', 'transform', 'x', 'y', 'x1', 'y1', 'x2', 'y2', 'cx', 'cy', 'r', 'rx', 'ry', 'fx', 'fy', 'dx', 'dy',
+    'width', 'height', 'viewBox'
+))
+
+COLOR_ATTRIBUTES = set(('fill', 'stroke', 'stop-color', 'flood-color', 'lighting-color', 'color', 'style'))
+
+NUMBER = re.compile(r'[-+]?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?')
+
+# #aabbcc, but not the id in url(#aabbcc)
+LONG_COLOR = re.compile(r'(?<![\w(\'"])#([0-9a-fA-F])\1([0-9a-fA-F])\2([0-9a-fA-F])\3(?![\w-])')
+
+
+def parse_page(source):
+    """
+    Parses a page. Comments are dropped while parsing.
+    """
+    parser = etree.XMLParser(remove_comments=True, huge_tree=True, resolve_entities=False)
+
+    return etree.fromstring(source.encode('utf-8') if isinstance(source, str) else source, parser)
+
+
+def serialize_page(root, pretty_print=False):
+    return etree.tostring(root.getroottree(), pretty_print=pretty_print)
+
+
+def remove_editor_data(root):
+    """
+    Removes the elements and attributes that are only used by Inkscape.
+    """
+    for element in list(root.iter()):
+        if not isinstance(element.tag, str):
+            continue
+
+        if element.tag.startswith('{') and element.tag[1:].split('}')[0] in EDITOR_NAMESPACES:
+            parent = element.getparent()
+            if parent is not None:
+                remove_element(element)
+            continue
+
+        for name in list(element.attrib):
+            if name.startswith('{') and name[1:].split('}')[0] in EDITOR_NAMESPACES:
+                del element.attrib[name]
+
+
+def remove_element(element):
+    """
+    Removes an element but keeps its tail, which belongs to the content of the parent.
+    """
+    parent = element.getparent()
+    previous = element.getprevious()
+
+    if element.tail:
+        if previous is not None:
+            previous.tail = (previous.tail or '') + element.tail
+        else:
+            parent.text = (parent.text or '') + element.tail
+
+    parent.remove(element)
+
+
+def get_property(element, name, presentation_attributes=True):
+    """
+    Returns the value of a style property set on an element, in lower case and without !important, or None.
+    The style attribute takes precedence over presentation attributes.
+    """
+    value = parse_style(element.get('style')).get(name)
+
+    if value is None and presentation_attributes:
+        value = element.get(name)
+
+    if value is None:
+        return None
+
+    return value.lower().replace('!important', '').strip()
+
+
+def is_hidden(element, presentation_attributes=True):
+    """
+    Returns True if an element and its content are not rendered: elements with display:none or opacity:0,
+    elements with visibility:hidden that have no visible content, Inkscape guides and guide layers.
+    """
+    if element.tag == '{%s}guide' % SODIPODI_NAMESPACE:
+        return True
+
+    if element.get('{%s}groupmode' % INKSCAPE_NAMESPACE) == 'layer' and \
+            (element.get('{%s}label' % INKSCAPE_NAMESPACE) or '').strip().lower() in GUIDE_LAYER_LABELS:
+        return True
+
+    if get_property(element, 'display', presentation_attributes) == 'none':
+        return True
+
+    opacity = get_property(element, 'opacity', presentation_attributes)
+
+    if opacity is not None:
+        try:
+            opacity = float(opacity[:-1]) / 100 if opacity.endswith('%') else float(opacity)
+        except ValueError:
+            opacity = 1
+
+        if opacity <= 0:
+            return True
+
+    # Visibility is inherited, but content can be made visible again
+    if get_property(element, 'visibility', presentation_attributes) in ('hidden', 'collapse'):
+        for node in element.iterdescendants():
+            if isinstance(node.tag, str) and get_property(node, 'visibility', presentation_attributes) == 'visible':
+                return False
+        return True
+
+    return False
+
+
+def remove_hidden_elements(root, keep_ids=(), presentation_attributes=True):
+    """
+    Removes the content of root that is not rendered, see is_hidden(). Elements that have an id in keep_ids, or
+    contain one, like the targets of <use> elements and clip paths, are kept, as are elements with animations.
+
+    :Args:
+      - root: element to remove hidden content from. The element itself is left alone.
+      - keep_ids: ids of the elements that are referenced
+      - presentation_attributes: also look at presentation attributes, like display="none". Style sheets can
+        override them, so leave them out when the document has style elements.
+
+    :Returns:
+      The number of elements removed
+    """
+    removed = 0
+    stack = list(root)
+
+    while stack:
+        element = stack.pop()
+
+        if not isinstance(element.tag, str):
+            continue
+
+        if is_hidden(element, presentation_attributes):
+            nodes = [node for node in element.iter() if isinstance(node.tag, str)]
+
+            if not any(node.get('id') in keep_ids or node.tag in ANIMATION_TAGS for node in nodes):
+                remove_element(element)
+                removed += len(nodes)
+                continue
+
+        stack.extend(element)
+
+    return removed
+
+
+def remove_whitespace(root):
+    """
+    Removes the whitespace between elements, except in text content.
+    """
+    pending = [root]
+
+    while len(pending) > 0:
+        element = pending.pop()
+
+        if element.text is not None and element.text.strip() == '':
+            element.text = None
+
+        for child in element:
+            if child.tail is not None and child.tail.strip() == '':
+                child.tail = None
+
+            if isinstance(child.tag, str) and child.tag not in TEXT_CONTENT_TAGS:
+                pending.append(child)
+
+
+def round_number(number, digits):
+    # Integers and numbers in scientific notation are left as they are
+    if '.' not in number or 'e' in number or 'E' in number:
+        return number
+
+    value = float(number)
+
+    if value == 0:
+        return '0'
+
+    decimals = max(digits - 1 - int(math.floor(math.log10(abs(value)))), 0)
+    rounded = '%.*f' % (decimals, value)
+
+    if '.' in rounded:
+        rounded = rounded.rstrip('0').rstrip('.')
+
+    return '0' if rounded in ('-0', '') else rounded
+
+
+def round_numbers(value, digits):
+    """
+    Rounds all numbers in an attribute value, like path data or a transform.
+    """
+    parts = []
+    position = 0
+
+    for match in NUMBER.finditer(value):
+        number = round_number(match.group(0), digits)
+
+        # Numbers like ".5" can follow another number without a separator. Once rounded they need one.
+        if match.start() == position and len(parts) > 0 and number[0] not in '+-':
+            parts.append(' ')
+
+        parts.append(value[position:match.start()])
+        parts.append(number)
+        position = match.end()
+
+    parts.append(value[position:])
+
+    return ''.join(parts)
+
+
+def reduce_precision(root, digits=5):
+    """
+    Rounds coordinates and lengths to a number of significant digits.
+    """
+    for element in root.iter():
+        if not isinstance(element.tag, str):
+            continue
+
+        for name, value in element.attrib.items():
+            if name in GEOMETRY_ATTRIBUTES:
+                element.set(name, round_numbers(value, digits))
+
+
+def shorten_colors(root):
+    """
+    Writes colors like #aabbcc as #abc.
+    """
+    for element in root.iter():
+        if not isinstance(element.tag, str):
+            continue
+
+        for name, value in element.attrib.items():
+            if name in COLOR_ATTRIBUTES and '#' in value:
+                element.set(name, LONG_COLOR.sub(r'#\1\2\3', value))
+
+
+def remove_empty_containers(root):
+    """
+    Removes empty groups and defs. Elements with an id are kept, scripts might look them up.
+    """
+    removed = True
+
+    # Removing a group can leave its parent empty
+    while removed:
+        removed = False
+
+        for element in list(root.iter(*CONTAINER_TAGS)):
+            if element is root or len(element) > 0 or (element.text or '').strip() != '':
+                continue
+
+            if element.get('id') is not None:
+                continue
+
+            remove_element(element)
+            removed = True
+
+
+def optimize_page(root, digits=5):
+    """
+    Runs the optimization passes on a page, in place.
+    """
+    remove_editor_data(root)
+    remove_whitespace(root)
+    remove_empty_containers(root)
+    reduce_precision(root, digits)
+    shorten_colors(root)
+    etree.cleanup_namespaces(root)
+
+    return root
@@ -0,0 +1,349 @@
+"""
+    MIT License
+
+    Copyright (c) 2020 Lars C Wallin <larscwallin@gmail.com>
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import collections
+import os
+import re
+import sys
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from lxml import etree
+
+sys.path.append('./')
+sys.path.append('./scour')
+
+import scour
+import scour.scour
+
+import larscwallin_inx_optimize as inx_optimize
+
+# The layer pipeline turns the serialized source of a single layer into a finished content document.
+# Layers are sent to the worker processes as strings and the finished documents come back as bytes, so that
+# layers can be rendered in parallel. In a worker the page is parsed once, optimized as a tree and serialized
+# once. The context holds the values that are shared by all layers of an export:
+#
+#   template     the SVG document template (ExportToEpub.svg_src_template)
+#   scripts      serialized script elements
+#   viewport     (width, height) tuple
+#   document     (width, height) tuple
+#   page         optional, the template compiled by compile_page_template()
+#   optimizer    optional, 'tree' (default) optimizes the parsed page, 'scour' runs the page through Scour
+#   pretty_print optional, indent the finished documents. Default is False.
+
+# Matches the {{name}} slots of the template
+TEMPLATE_SLOT = re.compile(r'\{\{([\w.-]+)\}\}')
+
+# Slots that are filled with the values of each layer
+LAYER_SLOTS = {'font-faces': 'font_faces', 'defs': 'defs', 'title': 'label', 'element.source': 'source'}
+
+# Set by the pool initializer in worker processes so that the shared context is only sent once per worker
+_worker_context = None
+
+
+def available_cpus():
+    """Returns the number of CPUs that this process is allowed to run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def scour_doc(source):
+    return scour.scour.scourString(source).encode("UTF-8")
+
+
+def compile_page_template(context):
+    """
+    Splits the template into static segments and the slots that are filled per layer. The values that are the
+    same for all layers are filled in here, once, and adjacent static segments are merged.
+
+    :Returns:
+      Tuple with the list of static segments and the list of layer slot names in between them. There is always
+      one segment more than there are slots.
+    """
+    values = {
+        'scripts': context['scripts'],
+        'viewport.width': str(context['viewport'][0]),
+        'viewport.height': str(context['viewport'][1]),
+        'document.width': str(context['document'][0]),
+        'document.height': str(context['document'][1])
+    }
+
+    segments = ['']
+    slots = []
+    position = 0
+
+    for match in TEMPLATE_SLOT.finditer(context['template']):
+        name = match.group(1)
+        static = context['template'][position:match.start()]
+        position = match.end()
+
+        if name in values:
+            segments[-1] += static + values[name]
+        elif name in LAYER_SLOTS:
+            segments[-1] += static
+            segments.append('')
+            slots.append(name)
+        else:
+            segments[-1] += static + match.group(0)
+
+    segments[-1] += context['template'][position:]
+
+    return segments, slots
+
+
+def fill_template(layer, context):
+    """
+    Returns the source of a layer wrapped in the document template, as a str.
+    """
+    segments, slots = context.get('page') or compile_page_template(context)
+    parts = [segments[0]]
+
+    for slot, segment in zip(slots, segments[1:]):
+        parts.append(layer[LAYER_SLOTS[slot]])
+        parts.append(segment)
+
+    return ''.join(parts)
+
+
+def reparse_doc(source, pretty_print=True):
+    """
+    Parses an optimized document and serializes it again.
+    """
+    # TODO: Add processing instsruction to head of file
+    content_doc = etree.fromstring(source)
+    content_doc = etree.ElementTree(content_doc)
+
+    return etree.tostring(content_doc, pretty_print=pretty_print)
+
+
+def render_layer(layer, context):
+    """
+    Wraps the source of a layer in an SVG document, optimizes it and returns the result as bytes.
+
+    :Args:
+      - layer: dict with the 'label', 'source' (str), 'defs' (str) and 'font_faces' (str, the @font-face
+        declarations of the fonts used by the layer) of the layer
+      - context: dict with the values shared by all layers
+
+    :Returns:
+      The finished document as bytes
+    """
+    return render_layer_with_stats(layer, context)[0]
+
+
+def render_layer_with_stats(layer, context):
+    """
+    Same as render_layer() but also measures the rendering.
+
+    :Returns:
+      Tuple with the finished document as bytes and a dict with the 'start' time and 'pid' of the rendering, the
+      seconds of each of the 'stages' and the size in bytes of the document before and after optimization.
+    """
+    pretty_print = context.get('pretty_print', False)
+    start = time.time()
+    tpl_result = fill_template(layer, context)
+    templated = time.time()
+    stats = {
+        'start': start,
+        'pid': os.getpid(),
+        'bytes_source': len(layer['source'].encode('utf-8')),
+        'bytes_in': len(tpl_result.encode('utf-8')),
+        'cached': False
+    }
+
+    if context.get('optimizer', 'tree') == 'scour':
+        scoured_result = scour_doc(tpl_result)
+        scoured = time.time()
+        document = reparse_doc(scoured_result, pretty_print)
+
+        stats['stages'] = {
+            'template': templated - start,
+            'scour': scoured - templated,
+            'reparse': time.time() - scoured
+        }
+        stats['bytes_scoured'] = len(scoured_result)
+    else:
+        root = inx_optimize.parse_page(tpl_result)
+        parsed = time.time()
+        inx_optimize.optimize_page(root)
+        optimized = time.time()
+        document = inx_optimize.serialize_page(root, pretty_print)
+
+        stats['stages'] = {
+            'template': templated - start,
+            'parse': parsed - templated,
+            'optimize': optimized - parsed,
+            'serialize': time.time() - optimized
+        }
+
+    stats['bytes_out'] = len(document)
+
+    return document, stats
+
+
+def _init_worker(context):
+    global _worker_context
+    _worker_context = context
+
+
+def _render_layer_in_worker(layer):
+    return render_layer_with_stats(layer, _worker_context)
+
+
+def get_cache_key(cache, layer, context):
+    """
+    Returns the cache key for a layer. Every value of the layer and the context is part of the key, as is the
+    scour version.
+    """
+    parts = [getattr(scour, '__version__', '')]
+
+    for values in (layer, context):
+        for name in sorted(values):
+            parts.append(name)
+            parts.append(repr(values[name]))
+
+    return cache.make_key(*parts)
+
+
+def render_layers(layers, context, jobs=0, cache=None, report=None):
+    """
+    Renders all layers and returns the finished documents in the same order as the layers were given.
+
+    :Args:
+      - layers: list of layer dicts, see render_layer()
+      - context: dict with the values shared by all layers
+      - jobs: number of worker processes. 0 uses all available CPUs and 1 renders in this process.
+      - cache: optional LayerCache. Layers found in the cache are not rendered again.
+      - report: optional BuildReport that the stats of each layer are added to
+
+    :Returns:
+      List of documents as bytes
+    """
+    return [document for index, document in iter_render_layers(enumerate(layers), context, jobs, cache, report)]
+
+
+def iter_render_layers(layers, context, jobs=0, cache=None, report=None):
+    """
+    Renders layers as they are taken from the layers iterable and yields the finished documents in the same order.
+    Only a few layers per worker are in flight at any time, so memory use does not grow with the number of layers.
+
+    :Args:
+      - layers: iterable of (tag, layer) tuples. The tag is passed through untouched.
+      - context: dict with the values shared by all layers
+      - jobs: number of worker processes. 0 uses all available CPUs and 1 renders in this process.
+      - cache: optional LayerCache. Layers found in the cache are not rendered again.
+      - report: optional BuildReport that the stats of each layer are added to. The tag is used as the layer.
+
+    :Returns:
+      Generator of (tag, document) tuples
+    """
+    if jobs <= 0:
+        jobs = available_cpus()
+
+    pool = None
+    if jobs > 1:
+        try:
+            pool = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(context,))
+        except (OSError, NotImplementedError) as err:
+            sys.stderr.write('Could not render layers in parallel (%s), falling back to a single process\n' % err)
+
+    # Each entry is [tag, layer, cache key, document or Future]
+    pending = collections.deque()
+    max_pending = jobs * 2 if pool is not None else 0
+    rendered = 0
+
+    try:
+        for tag, layer in layers:
+            key = None
+            document = None
+
+            if cache is not None:
+                key = get_cache_key(cache, layer, context)
+                document = cache.get(key)
+
+            if document is None:
+                rendered += 1
+
+                if pool is not None:
+                    try:
+                        document = pool.submit(_render_layer_in_worker, layer)
+                    except BrokenProcessPool as err:
+                        sys.stderr.write('Could not render layers in parallel (%s), falling back to a single '
+                                         'process\n' % err)
+                        pool = None
+                        max_pending = 0
+
+                if document is None:
+                    document = render_layer_with_stats(layer, context)
+
+                pending.append([tag, layer, key, document])
+            else:
+                pending.append([tag, layer, None, document])
+
+            while len(pending) > max_pending:
+                yield _finish_layer(pending.popleft(), context, cache, report)
+
+        while len(pending) > 0:
+            yield _finish_layer(pending.popleft(), context, cache, report)
+    finally:
+        if pool is not None:
+            # Layers that have not started are not rendered when the export failed. shutdown() can only cancel
+            # them itself from Python 3.9.
+            for entry in pending:
+                if isinstance(entry[3], Future):
+                    entry[3].cancel()
+
+            pool.shutdown(wait=True)
+
+    if cache is not None and rendered > 0:
+        cache.trim()
+
+
+def _finish_layer(entry, context, cache, report):
+    tag, layer, key, document = entry
+    stats = None
+
+    if isinstance(document, Future):
+        try:
+            document = document.result()
+        except BrokenProcessPool:
+            document = render_layer_with_stats(layer, context)
+
+    if isinstance(document, tuple):
+        document, stats = document
+
+        if key is not None:
+            cache.put(key, document)
+    else:
+        # Taken from the cache
+        stats = {'stages': {}, 'bytes_source': len(layer['source'].encode('utf-8')), 'bytes_out': len(document),
+                 'cached': True}
+
+    if report is not None:
+        report.add_layer(tag, stats)
+
+    return tag, document
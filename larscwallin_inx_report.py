@@ -0,0 +1,136 @@
+"""
+    MIT License
+
+    Copyright (c) 2020 Lars C Wallin <larscwallin@gmail.com>
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class BuildReport(object):
+    """
+    Timers and counters for one export.
+
+    Stages are timed with the stage() context manager and can be nested. Every timed stage is also recorded as
+    an event for the Chrome trace format, which can be opened in chrome://tracing or https://ui.perfetto.dev.
+    Layers are rendered in worker processes, so their timings are measured there and added with add_layer().
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.layers = []
+        self.values = {}
+        self.events = []
+
+    def _add_event(self, name, start, seconds, pid=None, tid=None, args=None):
+        event = {
+            'name': name,
+            'ph': 'X',
+            'ts': int((start - self.start) * 1000000),
+            'dur': int(seconds * 1000000),
+            'pid': pid if pid is not None else os.getpid(),
+            'tid': tid if tid is not None else threading.get_ident()
+        }
+
+        if args:
+            event['args'] = args
+
+        self.events.append(event)
+
+    def add_time(self, name, seconds, calls=1):
+        stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+        stage['seconds'] += seconds
+        stage['calls'] += calls
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Times the block as the named stage. A stage that runs many times is summed up.
+        """
+        start = time.time()
+
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            self.add_time(name, seconds)
+            self._add_event(name, start, seconds)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        """
+        Records a value, like the compression report of the EPUB writer, as it is.
+        """
+        self.values[name] = value
+
+    def add_layer(self, layer, stats):
+        """
+        Adds the stats of a rendered layer.
+
+        :Args:
+          - layer: dict with the 'id' and 'label' of the layer
+          - stats: dict returned by the layer pipeline. Holds the 'start' time, 'pid' and seconds per stage of
+            the rendering, the bytes in and out of each stage, and whether the layer was 'cached'.
+        """
+        entry = dict(layer)
+        entry['index'] = len(self.layers)
+        entry.update((name, value) for name, value in stats.items() if name not in ('start', 'pid', 'stages'))
+        entry['seconds'] = sum(stats.get('stages', {}).values())
+        self.layers.append(entry)
+
+        self.count('layers')
+        self.count('layers cached' if stats.get('cached') else 'layers rendered')
+
+        start = stats.get('start', time.time())
+        name = entry.get('label') or entry.get('id') or 'layer'
+
+        for stage, seconds in stats.get('stages', {}).items():
+            self.add_time('layer ' + stage, seconds)
+            self._add_event(stage, start, seconds, stats.get('pid'), stats.get('pid'), {'layer': name})
+            start += seconds
+
+    def get_report(self):
+        """
+        Returns the report as a dict. Layers are sorted with the slowest first.
+        """
+        return {
+            'seconds': time.time() - self.start,
+            'stages': self.stages,
+            'counters': self.counters,
+            'values': self.values,
+            'layers': sorted(self.layers, key=lambda layer: layer['seconds'], reverse=True)
+        }
+
+    def write(self, path):
+        with open(path, 'w') as handle:
+            json.dump(self.get_report(), handle, indent=2)
+
+    def write_trace(self, path):
+        with open(path, 'w') as handle:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, handle)
@@ -0,0 +1,223 @@
+"""
+    MIT License
+
+    Copyright (c) 2020 Lars C Wallin <larscwallin@gmail.com>
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import collections
+import fnmatch
+import os
+import posixpath
+import re
+import urllib.parse
+
+# Version control folders, and files that operating systems and editors leave behind
+IGNORED_NAMES = set((
+    '.git', '.svn', '.hg', '.bzr', 'CVS', '__pycache__', '.DS_Store', '.AppleDouble', '.Spotlight-V100',
+    '.Trashes', '.directory', 'Thumbs.db', 'ehthumbs.db', 'desktop.ini', '.gitignore', '.gitattributes',
+    '.gitkeep'
+))
+
+IGNORED_PATTERNS = ('._*', '*~', '*.swp', '*.tmp', '.~lock.*')
+
+FONT_EXTENSIONS = ('.ttf', '.otf', '.woff', '.woff2', '.eot')
+
+# Splits file names into lower case words
+NAME_TOKEN = re.compile(r'[^\W_]+')
+
+# Style sheets and HTML files, whose references to other resources are updated when a resource is renamed
+TEXT_EXTENSIONS = ('.css', '.html', '.htm', '.xhtml')
+
+# CSS url() values and HTML href and src attributes, without the query and fragment
+RESOURCE_URL = re.compile(r'''(url\(\s*["']?|\b(?:href|src)\s*=\s*["'])([^)"'\s#?]+)''')
+
+ResourceEntry = collections.namedtuple('ResourceEntry', [
+    'path', 'relative_path', 'size', 'mtime', 'extension', 'tokens'
+])
+
+
+def is_ignored(name):
+    return name in IGNORED_NAMES or any(fnmatch.fnmatchcase(name, pattern) for pattern in IGNORED_PATTERNS)
+
+
+def get_tokens(name):
+    return tuple(token.lower() for token in NAME_TOKEN.findall(name))
+
+
+def rewrite_urls(text, file_name, renamed):
+    """
+    Points the relative URLs in a style sheet or HTML file at the new names of renamed files.
+
+    :Args:
+      - text: content of the file
+      - file_name: path of the file in the EPUB
+      - renamed: dict of old path -> new path in the EPUB
+
+    :Returns:
+      The rewritten text
+    """
+    folder = posixpath.dirname(file_name)
+
+    def replace(match):
+        url = match.group(2)
+
+        # Absolute URLs and URLs with a scheme do not point into the EPUB
+        if url[:1] == '/' or urllib.parse.urlparse(url).scheme != '':
+            return match.group(0)
+
+        new_name = renamed.get(posixpath.normpath(posixpath.join(folder, urllib.parse.unquote(url))))
+        if new_name is None:
+            return match.group(0)
+
+        return match.group(1) + urllib.parse.quote(posixpath.relpath(new_name, folder or '.'))
+
+    return RESOURCE_URL.sub(replace, text)
+
+
+class ResourceIndex(object):
+    """
+    Index of the files in the resources folder, built with a single walk at the start of an export.
+
+    Entries are kept in the order that the folder was walked in, and can be looked up by path, by path relative
+    to the project root folder, by extension and by the words in their names.
+    """
+
+    def __init__(self, root_folder, resources_folder):
+        """
+        :Args:
+          - root_folder: project root folder. Relative paths in the EPUB are relative to this folder.
+          - resources_folder: folder to index, relative to the root folder
+        """
+        self.root_folder = os.path.abspath(os.path.expanduser(root_folder))
+        self.folder = os.path.join(self.root_folder, resources_folder)
+        self.entries = []
+        # absolute path -> entry
+        self.paths = {}
+        # path relative to the root folder -> entry
+        self.relative_paths = {}
+        # lower case extension, like '.ttf' -> list of entries
+        self.extensions = {}
+        # lower case word -> list of entries with the word in their name
+        self.tokens = {}
+        # (name, extensions) -> path, for find_fuzzy()
+        self.fuzzy = {}
+        self.ignored = 0
+
+        if os.path.isdir(self.folder):
+            self._scan(self.folder)
+
+    def _scan(self, folder):
+        try:
+            # Sorted, so that the order does not depend on the file system. Of files with the same content, the
+            # first one is kept when deduplicating.
+            with os.scandir(folder) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError:
+            return
+
+        for entry in entries:
+            if is_ignored(entry.name):
+                self.ignored += 1
+                continue
+
+            try:
+                if entry.is_dir():
+                    self._scan(entry.path)
+                    continue
+
+                stat = entry.stat()
+            except OSError:
+                continue
+
+            path = os.path.abspath(entry.path)
+            relative_path = os.path.relpath(path, self.root_folder).replace(os.sep, '/')
+            extension = os.path.splitext(entry.name)[1].lower()
+
+            resource = ResourceEntry(path, relative_path, stat.st_size, stat.st_mtime, extension,
+                                     get_tokens(entry.name))
+
+            self.entries.append(resource)
+            self.paths[path] = resource
+            self.relative_paths[relative_path] = resource
+            self.extensions.setdefault(extension, []).append(resource)
+
+            for token in set(resource.tokens):
+                self.tokens.setdefault(token, []).append(resource)
+
+    def get(self, path):
+        """
+        Returns the entry of a file, or None if it is not in the resources folder.
+        """
+        return self.paths.get(os.path.abspath(os.path.expanduser(path)))
+
+    def get_relative_path(self, path):
+        """
+        Returns the path of a file relative to the root folder, with forward slashes.
+        """
+        entry = self.get(path)
+
+        if entry is not None:
+            return entry.relative_path
+
+        return os.path.relpath(os.path.abspath(os.path.expanduser(path)), self.root_folder).replace(os.sep, '/')
+
+    def find_fuzzy(self, name, extensions=None):
+        """
+        Returns the path of the first file whose name contains name and has an extension, or None. Like a
+        search for '*name*.*' but answered from the index.
+
+        :Args:
+          - name: part of the file name
+          - extensions: optional list of lower case extensions, like ['.ttf', '.otf'], to limit the search to
+        """
+        key = (name, tuple(extensions) if extensions else None)
+
+        if key not in self.fuzzy:
+            self.fuzzy[key] = self._find_fuzzy(name, extensions)
+
+        return self.fuzzy[key]
+
+    def _find_fuzzy(self, name, extensions):
+        tokens = get_tokens(name)
+        candidates = None
+
+        # Narrow the search down to the files that have all the words of the name in them. Names that are
+        # only part of a word, like "Sans" in "OpenSans", are not found that way, so then all files are searched.
+        for token in tokens:
+            entries = self.tokens.get(token, [])
+            candidates = set(entries) if candidates is None else candidates.intersection(entries)
+
+        searches = [self.entries]
+        if candidates:
+            searches.insert(0, [entry for entry in self.entries if entry in candidates])
+
+        for entries in searches:
+            for entry in entries:
+                if extensions and entry.extension not in extensions:
+                    continue
+
+                file_name = os.path.basename(entry.path)
+                position = file_name.find(name)
+
+                if position >= 0 and '.' in file_name[position + len(name):]:
+                    return entry.path
+
+        return None